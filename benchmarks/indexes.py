@@ -0,0 +1,147 @@
+"""Время горячих запросов до и после миграции с индексами.
+
+    python benchmarks/indexes.py --users 500000 --chats 2000000 --messages 5000000
+
+Строит базу на схеме версии 3 (без индексов), замеряет запросы, применяет
+миграцию 4 и замеряет снова. База пересоздаётся при каждом запуске.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+# (название, SQL, генератор параметров)
+QUERIES = [
+    ("active chat by user",
+     "SELECT id FROM chats WHERE (user1_id=? OR user2_id=?) AND ended=0 LIMIT 1",
+     lambda a: (a.uid(), a.uid())),
+    ("open chats (startup)",
+     "SELECT id, user1_id, user2_id FROM chats WHERE ended=0 ORDER BY id",
+     lambda a: ()),
+    ("dialog page",
+     "SELECT id, display, content, ts FROM messages WHERE chat_id=? ORDER BY id DESC LIMIT 30",
+     lambda a: (a.cid(),)),
+    ("already rated",
+     "SELECT 1 FROM ratings WHERE rater_id=? AND chat_id=?",
+     lambda a: (a.uid(), a.cid())),
+    ("already reported",
+     "SELECT 1 FROM reports WHERE reporter_id=? AND chat_id=?",
+     lambda a: (a.uid(), a.cid())),
+    ("pending reports",
+     "SELECT COUNT(*) FROM reports WHERE status='pending'",
+     lambda a: ()),
+    ("banned users",
+     "SELECT COUNT(*) FROM users WHERE is_banned=1",
+     lambda a: ()),
+    ("promo page",
+     "SELECT u.user_id FROM users u WHERE u.is_banned=0 AND u.user_id>? AND u.user_id NOT IN ("
+     "  SELECT user1_id FROM chats WHERE ended=0"
+     "  UNION ALL SELECT user2_id FROM chats WHERE ended=0"
+     "  UNION ALL SELECT user_id FROM queue"
+     ") ORDER BY u.user_id LIMIT 500",
+     lambda a: (a.uid(),)),
+]
+
+
+class Args:
+    def __init__(self, ns):
+        self.users, self.chats = ns.users, ns.chats
+
+    def uid(self):
+        return random.randint(1, self.users)
+
+    def cid(self):
+        return random.randint(1, self.chats)
+
+
+def populate(c, ns):
+    rnd = random.Random(1)
+    batch = 100_000
+    now = time.time()
+
+    def chunks(total, make):
+        for start in range(0, total, batch):
+            yield [make(i) for i in range(start + 1, min(start + batch, total) + 1)]
+
+    for rows in chunks(ns.users, lambda i: (i, f"u{i}", rnd.choice("MF"), rnd.randint(14, 60),
+                                            int(rnd.random() < 0.01))):
+        c.executemany("INSERT INTO users (user_id, name, gender, age, is_banned) VALUES (?,?,?,?,?)", rows)
+    # Около 1% чатов ещё открыты — как в живой базе
+    for rows in chunks(ns.chats, lambda i: (i, rnd.randint(1, ns.users), rnd.randint(1, ns.users),
+                                            int(rnd.random() >= 0.01), now - rnd.randint(0, 90 * 86400))):
+        c.executemany("INSERT INTO chats (id, user1_id, user2_id, ended, ended_at) VALUES (?,?,?,?,?)", rows)
+    for rows in chunks(ns.messages, lambda i: (rnd.randint(1, ns.chats), rnd.randint(1, ns.users),
+                                               "Аноним", "привет", "12:00", now)):
+        c.executemany("INSERT INTO messages (chat_id, sender_id, display, content, ts, created_at) "
+                      "VALUES (?,?,?,?,?,?)", rows)
+    side = ns.chats // 10
+    for rows in chunks(side, lambda i: (rnd.randint(1, ns.users), rnd.randint(1, ns.users),
+                                        rnd.randint(1, ns.chats), rnd.randint(1, 5))):
+        c.executemany("INSERT INTO ratings (rater_id, rated_id, chat_id, score) VALUES (?,?,?,?)", rows)
+    for rows in chunks(side, lambda i: (rnd.randint(1, ns.users), rnd.randint(1, ns.users),
+                                        rnd.randint(1, ns.chats),
+                                        "pending" if rnd.random() < 0.02 else "banned")):
+        c.executemany("INSERT INTO reports (reporter_id, reported_id, chat_id, status) VALUES (?,?,?,?)", rows)
+    c.commit()
+
+
+def measure(c, args, repeat):
+    result = {}
+    for name, sql, params in QUERIES:
+        # Запросы без параметров дорогие без индекса — хватит нескольких повторов
+        n = repeat if params(args) else max(3, repeat // 100)
+        t0 = time.perf_counter()
+        for _ in range(n):
+            c.execute(sql, params(args)).fetchall()
+        result[name] = (time.perf_counter() - t0) / n * 1000
+    return result
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--db", default="bench_indexes.db")
+    p.add_argument("--users", type=int, default=500_000)
+    p.add_argument("--chats", type=int, default=2_000_000)
+    p.add_argument("--messages", type=int, default=5_000_000)
+    p.add_argument("--repeat", type=int, default=300)
+    ns = p.parse_args()
+
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(ns.db + suffix):
+            os.remove(ns.db + suffix)
+    c = sqlite3.connect(ns.db)
+    bot.migrate(c, target=3)
+
+    t0 = time.perf_counter()
+    populate(c, ns)
+    print(f"populated in {time.perf_counter() - t0:.1f}s: {ns.users} users, "
+          f"{ns.chats} chats, {ns.messages} messages")
+
+    args = Args(ns)
+    random.seed(2)
+    before = measure(c, args, ns.repeat)
+
+    t0 = time.perf_counter()
+    bot.migrate(c, target=4)
+    c.execute("ANALYZE")
+    print(f"migration 4 + ANALYZE in {time.perf_counter() - t0:.1f}s")
+
+    random.seed(2)
+    after = measure(c, args, ns.repeat)
+    c.close()
+
+    print(f"\n{'query':<24}{'before, ms':>14}{'after, ms':>14}{'speedup':>10}")
+    for name, _, _ in QUERIES:
+        b, a = before[name], after[name]
+        print(f"{name:<24}{b:>14.3f}{a:>14.3f}{b / a:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""Нагрузочный прогон хэндлеров без Telegram.
+
+    python benchmarks/load.py --users 2000 --messages 10 --latency 0.05
+
+Апдейты подаются в настоящий Dispatcher через feed_update, а Bot API
+заменён сессией-заглушкой: она считает вызовы и отвечает с задержкой
+--latency секунд (±50%). Все виртуальные пользователи работают
+одновременно, каждый шлёт свои апдейты по очереди, как живой клиент.
+
+По каждой фазе печатаются p50/p95/p99 времени обработки апдейта,
+апдейтов в секунду, SQL-операторов и вызовов API на апдейт и пик памяти
+(tracemalloc; --no-memory отключает его, он заметно замедляет прогон).
+--engine memory гоняет ту же нагрузку на базе в памяти — без диска.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+_tmp = tempfile.mkdtemp(prefix="bench_load_")
+os.environ["DB_PATH"]     = os.path.join(_tmp, "load.db")
+os.environ["ARCHIVE_DIR"] = os.path.join(_tmp, "archive")
+os.environ["BOT_TOKEN"]   = "123456:BENCHMARKbenchmarkBENCHMARKbenchmark"
+os.environ.pop("METRICS_PORT", None)
+if "--engine" in sys.argv:   # движок выбирается при импорте bot — до argparse
+    os.environ["DB_ENGINE"] = sys.argv[sys.argv.index("--engine") + 1]
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.types import Chat, Message, MessageId, Update, User  # noqa: E402
+
+import bot as app  # noqa: E402
+
+
+class StubSession(BaseSession):
+    """Сессия Bot API без сети: пишет имя метода и отвечает правдоподобным
+    объектом после искусственной задержки."""
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls   = Counter()
+        self._ids    = iter(range(1, 1 << 62))
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[method.__api_method__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        return self._result(method)
+
+    def _result(self, method):
+        returning = method.__returning__
+        if returning is bool:
+            return True
+        if returning is MessageId:
+            return MessageId(message_id=next(self._ids))
+        if returning is User:
+            return User(id=1, is_bot=True, first_name="bench", username="bench_bot")
+        if getattr(returning, "__origin__", None) is list:
+            return []
+        chat_id = getattr(method, "chat_id", None) or 0
+        return Message(message_id=next(self._ids), date=datetime.now(),
+                       chat=Chat(id=chat_id, type="private"))
+
+    async def stream_content(self, *args, **kwargs):
+        raise NotImplementedError
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class Harness:
+    def __init__(self, bot, dp):
+        self.bot, self.dp = bot, dp
+        self.session      = bot.session
+        self.statements   = 0
+        self._update_id   = 0
+        self._lock        = threading.Lock()   # трейс зовут и писатель, и читатели
+        app.db.trace      = self._trace        # до открытия соединений, т. е. до warm_up
+
+    def _trace(self, sql):
+        with self._lock:
+            self.statements += 1
+
+    def _next_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def _message(self, uid, **fields):
+        return {
+            "message_id": self._next_id(), "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": f"u{uid}"},
+            **fields,
+        }
+
+    def text(self, uid, text):
+        return {"update_id": self._next_id(), "message": self._message(uid, text=text)}
+
+    def photo(self, uid):
+        size = {"file_id": "AgAD", "file_unique_id": "AQAD", "width": 90, "height": 90}
+        return {"update_id": self._next_id(), "message": self._message(uid, photo=[size])}
+
+    def callback(self, uid, data):
+        return {"update_id": self._next_id(), "callback_query": {
+            "id": str(self._next_id()), "chat_instance": "bench", "data": data,
+            "from": {"id": uid, "is_bot": False, "first_name": f"u{uid}"},
+            "message": self._message(uid, text="…"),
+        }}
+
+    async def feed(self, raw, latencies):
+        update = Update.model_validate(raw, context={"bot": self.bot})
+        t0 = time.perf_counter()
+        await self.dp.feed_update(self.bot, update)
+        latencies.append(time.perf_counter() - t0)
+
+    async def settle(self):
+        """Дождаться исходящих очередей и записать отложенные буферы, чтобы
+        их запросы попали в счёт своей фазы."""
+        while len(app.outbox):
+            await asyncio.sleep(0.01)
+        await app.msg_log.flush()
+        await app.counters.flush()
+        await app.fsm_storage.flush()
+
+    async def phase(self, name, scripts, memory):
+        """scripts: {uid: [raw update, …]} — у каждого пользователя свой поток."""
+        latencies = []
+        stmts0, calls0 = self.statements, sum(self.session.calls.values())
+        if memory:
+            tracemalloc.reset_peak()
+
+        async def user(updates):
+            for raw in updates:
+                await self.feed(raw, latencies)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(user(u) for u in scripts.values()))
+        wall = time.perf_counter() - t0
+        await self.settle()
+
+        n = len(latencies)
+        if not n:
+            return
+        latencies.sort()
+
+        def pct(p):
+            return latencies[min(n - 1, int(n * p))] * 1000
+
+        peak = f"{tracemalloc.get_traced_memory()[1] / 2**20:8.1f}" if memory else f"{'-':>8}"
+        print(f"{name:<10}{n:>8}{pct(0.50):>9.2f}{pct(0.95):>9.2f}{pct(0.99):>9.2f}"
+              f"{n / wall:>10.0f}{(self.statements - stmts0) / n:>9.2f}"
+              f"{(sum(self.session.calls.values()) - calls0) / n:>8.2f}{peak}")
+
+
+async def run(ns):
+    logging.getLogger().setLevel(logging.WARNING)
+    random.seed(ns.seed)
+    if ns.memory:
+        tracemalloc.start()
+
+    bot = Bot(token=app.BOT_TOKEN, session=StubSession(ns.latency))
+    bot.session.middleware(app.api_metrics)
+    dp = app.build_dispatcher()
+
+    h = Harness(bot, dp)
+    await app.warm_up(bot)
+    app.msg_log.start()
+    app.counters.start()
+    app.fsm_storage.start()
+    app.outbox.start(bot)
+
+    uids = list(range(1_000_000, 1_000_000 + ns.users))
+
+    print(f"{ns.users} users, {ns.messages} messages each, API latency {ns.latency * 1000:.0f} ms, "
+          f"engine {app.DB_ENGINE}\n")
+    print(f"{'phase':<10}{'updates':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'upd/s':>10}{'sql/upd':>9}{'api/upd':>8}{'peak MB':>8}")
+
+    await h.phase("register", {uid: [
+        h.text(uid, "/start"),
+        h.text(uid, f"User{uid % 1000}"),
+        h.text(uid, random.choice(("👦 Мужской", "👧 Женский"))),
+        h.text(uid, str(random.randint(14, 40))),
+    ] for uid in uids}, ns.memory)
+
+    await h.phase("find", {uid: [h.text(uid, "🔍 Найти чат")] for uid in uids}, ns.memory)
+
+    paired = [uid for uid in uids if app.get_partner(uid)]
+    await h.phase("chat", {uid: [
+        h.photo(uid) if i == ns.messages // 2 else h.text(uid, f"message {i} from {uid}")
+        for i in range(ns.messages)
+    ] for uid in paired}, ns.memory)
+
+    await h.phase("profile", {uid: [
+        h.text(uid, "👤 Профиль"), h.callback(uid, "prefs"), h.callback(uid, "pref_g_any"),
+    ] for uid in uids}, ns.memory)
+
+    # Выходит один из пары; он же ставит оценку через инлайн-кнопку
+    leavers = {}
+    for uid in paired:
+        pid, cid = app.active_chats[uid]
+        if pid not in leavers:
+            leavers[uid] = (pid, cid)
+    await h.phase("leave", {uid: [h.text(uid, "🚪 Покинуть чат")] for uid in leavers}, ns.memory)
+    await h.phase("rate", {uid: [h.callback(uid, f"rate_{pid}_{cid}_{random.randint(1, 5)}")]
+                           for uid, (pid, cid) in leavers.items()}, ns.memory)
+
+    print("\nAPI calls:", ", ".join(f"{k}={v}" for k, v in h.session.calls.most_common()))
+
+    await app.outbox.close()
+    await app.msg_log.close()
+    await app.counters.close()
+    await app.fsm_storage.close()
+    await app.db.close()
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--messages", type=int, default=10, help="сообщений на пользователя в фазе chat")
+    p.add_argument("--latency", type=float, default=0.05, help="задержка Bot API, секунды")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--engine", choices=sorted(app.ENGINES), default=app.DB_ENGINE)
+    p.add_argument("--no-memory", dest="memory", action="store_false", help="без tracemalloc")
+    asyncio.run(run(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
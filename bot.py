@@ -1,19 +1,38 @@
 import asyncio
 import logging
+import gzip
+import html
+import json
+import tempfile
 import random
+import secrets
 import sqlite3
 import os
-
+import pathlib
+import time
+import itertools
+import weakref
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramForbiddenError,
+    TelegramBadRequest,
+)
 from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton,
-    ReplyKeyboardRemove,
+    ReplyKeyboardRemove, FSInputFile,
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -36,131 +55,1689 @@ class ChangeName(StatesGroup):
 class Broadcast(StatesGroup):
     waiting = State()
 
+# ═══════════════════════════════════════════════════════════════
+#  МЕТРИКИ
+# ═══════════════════════════════════════════════════════════════
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))   # 0 — без HTTP-эндпоинта
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+
+REGISTRY = []
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def _labels(names, values):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock   = threading.Lock()   # пишут и event loop, и поток БД
+        REGISTRY.append(self)
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self):
+        for labels, v in list(self._values.items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {v}"
+
+class Gauge:
+    """Значение читается в момент выдачи метрик из fn()."""
+    kind = "gauge"
+
+    def __init__(self, name, help, fn):
+        self.name, self.help, self.fn = name, help, fn
+        REGISTRY.append(self)
+
+    def render(self):
+        yield f"{self.name} {self.fn()}"
+
+class Histogram:
+    kind = "histogram"
+    BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._values = {}   # labels → [counts по бакетам..., sum, count]
+        self._lock   = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            v = self._values.get(labels)
+            if v is None:
+                v = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    v[i] += 1
+            v[-2] += value
+            v[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def render(self):
+        names = self.labels + ("le",)
+        for labels, v in list(self._values.items()):
+            for b, n in zip(self.buckets, v):
+                yield f"{self.name}_bucket{_labels(names, labels + (b,))} {n}"
+            yield f"{self.name}_bucket{_labels(names, labels + ('+Inf',))} {v[-1]}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {v[-2]}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {v[-1]}"
+
+def render_metrics():
+    lines = []
+    for m in REGISTRY:
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработки апдейта хэндлером", ("handler",))
+DB_SECONDS      = Histogram("bot_db_query_seconds", "Время выполнения запроса в потоке БД", ("statement",))
+API_SECONDS     = Histogram("bot_api_request_seconds", "Время запроса к Telegram Bot API", ("method",))
+API_ERRORS      = Counter("bot_api_errors_total", "Ошибки Telegram Bot API", ("method", "error"))
+RELAYED         = Counter("bot_relayed_messages_total", "Пересланные сообщения")
+QUEUE_EXPIRED   = Counter("bot_queue_expired_total", "Снятые с поиска по QUEUE_TTL")
+
+async def handler_metrics(handler, event, data):
+    """Middleware роутера: гистограмма времени по имени хэндлера."""
+    with HANDLER_SECONDS.time(data["handler"].callback.__name__):
+        return await handler(event, data)
+
+async def api_metrics(make_request, bot, method):
+    """Middleware сессии: время и ошибки каждого вызова Bot API."""
+    name = method.__api_method__
+    t0 = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        API_ERRORS.inc(name, type(e).__name__)
+        raise
+    finally:
+        API_SECONDS.observe(time.perf_counter() - t0, name)
+
+# ── Готовность ──────────────────────────────────────────────────
+# ready выставляется в main() после прогрева и снимается при остановке;
+# /readyz (на сервере метрик и вебхука) отвечает 503, пока его нет.
+ready = asyncio.Event()
+
+async def readyz(request):
+    return web.json_response({"ready": ready.is_set()}, status=200 if ready.is_set() else 503)
+
+Gauge("bot_ready", "1 — прогрев завершён, бот принимает апдейты", lambda: int(ready.is_set()))
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+
+    async def handle(request):
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    app.router.add_get("/readyz", readyz)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
 # ═══════════════════════════════════════════════════════════════
 #  БАЗА ДАННЫХ
 # ═══════════════════════════════════════════════════════════════
-conn = sqlite3.connect("chat.db", check_same_thread=False)
-conn.row_factory = sqlite3.Row
-conn.executescript("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id       INTEGER PRIMARY KEY,
-        name          TEXT NOT NULL,
-        gender        TEXT NOT NULL,
-        age           INTEGER NOT NULL,
-        chats_count   INTEGER DEFAULT 0,
-        messages_sent INTEGER DEFAULT 0,
-        is_banned     INTEGER DEFAULT 0,
-        referred_by   INTEGER DEFAULT NULL,
-        ref_count     INTEGER DEFAULT 0,
-        rating_sum    INTEGER DEFAULT 0,
-        rating_count  INTEGER DEFAULT 0
-    );
-    CREATE TABLE IF NOT EXISTS chats (
-        id        INTEGER PRIMARY KEY AUTOINCREMENT,
-        user1_id  INTEGER,
-        user2_id  INTEGER,
-        ended     INTEGER DEFAULT 0
-    );
-    CREATE TABLE IF NOT EXISTS messages (
-        id        INTEGER PRIMARY KEY AUTOINCREMENT,
-        chat_id   INTEGER,
-        sender_id INTEGER,
-        display   TEXT,
-        content   TEXT,
-        ts        TEXT DEFAULT (strftime('%H:%M', 'now', 'localtime'))
-    );
-    CREATE TABLE IF NOT EXISTS queue (
-        user_id INTEGER PRIMARY KEY
-    );
-    CREATE TABLE IF NOT EXISTS reports (
-        id          INTEGER PRIMARY KEY AUTOINCREMENT,
-        reporter_id INTEGER,
-        reported_id INTEGER,
-        chat_id     INTEGER,
-        status      TEXT DEFAULT 'pending'
-    );
-    CREATE TABLE IF NOT EXISTS ratings (
-        id       INTEGER PRIMARY KEY AUTOINCREMENT,
-        rater_id INTEGER,
-        rated_id INTEGER,
-        chat_id  INTEGER,
-        score    INTEGER
-    );
-""")
-conn.commit()
+DB_PATH     = os.environ.get("DB_PATH", "chat.db")
+DB_ENGINE   = os.environ.get("DB_ENGINE", "memory" if DB_PATH == ":memory:" else "sqlite")
+DB_READERS  = int(os.environ.get("DB_READERS", "4"))
+DB_CACHE_MB = int(os.environ.get("DB_CACHE_MB", "64"))    # page cache на соединение
+DB_MMAP_MB  = int(os.environ.get("DB_MMAP_MB", "256"))
+
+# ── Движки ──────────────────────────────────────────────────────
+# Движок решает, как открыть соединение и сколько может быть читателей;
+# SQL и код хэндлеров от него не зависят.
+
+class SQLiteEngine:
+    """Файл на диске в режиме WAL: один писатель и пул читателей, которые
+    не ждут запись. synchronous=NORMAL в WAL не теряет целостность, а при
+    сбое питания — максимум последние транзакции."""
+
+    def __init__(self, path, readers=DB_READERS, cache_mb=DB_CACHE_MB, mmap_mb=DB_MMAP_MB):
+        self.path     = path
+        self.readers  = readers
+        self.cache_mb = cache_mb
+        self.mmap_mb  = mmap_mb
+
+    def connect(self, readonly=False):
+        if readonly:
+            uri  = pathlib.Path(self.path).absolute().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute(f"PRAGMA cache_size=-{self.cache_mb * 1024}")
+        conn.execute(f"PRAGMA mmap_size={self.mmap_mb * 2**20}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+class MemoryEngine:
+    """Вся база в памяти процесса — для тестов и бенчмарков. У :memory:
+    каждое соединение — своя база, поэтому читателей нет: всё идёт
+    через писателя."""
+
+    readers = 0
+
+    def connect(self, readonly=False):
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+ENGINES = {"sqlite": SQLiteEngine, "memory": lambda path: MemoryEngine()}
+
+class Database:
+    """Асинхронный доступ к SQLite: запросы выполняются в отдельных потоках,
+    event loop продолжает обрабатывать апдейты, пока идёт дисковый I/O.
+
+    Запись (run, transaction, execute, update) — в одном потоке писателя:
+    sqlite3 не любит конкурентную запись, а порядок сохраняется сам собой.
+    fetchone/fetchall/scalar/read — на пуле читателей, если движок их
+    допускает. Читатель видит всё, что закоммичено до начала запроса; кому
+    важен порядок относительно записей других корутин — fresh=True."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.conn   = None
+        self.trace  = None   # sqlite3 trace callback для новых соединений (бенчмарки)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self._readers  = (ThreadPoolExecutor(max_workers=engine.readers, thread_name_prefix="db-read")
+                          if engine.readers else None)
+        self._local    = threading.local()
+        self._reader_conns = []
+
+    def _open(self, readonly):
+        conn = self.engine.connect(readonly)
+        if self.trace:
+            conn.set_trace_callback(self.trace)
+        return conn
+
+    def _call(self, fn, args, label):
+        if self.conn is None:
+            self.conn = self._open(False)
+        with DB_SECONDS.time(label):
+            return fn(self.conn, *args)
+
+    def _read_call(self, fn, args, label):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._open(True)
+            self._reader_conns.append(conn)
+        with DB_SECONDS.time(label):
+            return fn(conn, *args)
+
+    async def run(self, fn, *args, label=None):
+        """Выполнить fn(conn, *args) в потоке писателя. label — имя для метрик."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args, label or fn.__name__)
+
+    async def read(self, fn, *args, label=None, fresh=False):
+        """Как run, но только для чтения: параллельно с записью и друг с другом."""
+        if self._readers is None or fresh:
+            return await self.run(fn, *args, label=label)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._read_call, fn, args, label or fn.__name__)
+
+    async def warm_readers(self, fn):
+        """Выполнить fn(conn) на каждом читателе, заодно открыв соединения.
+        Барьер не даёт одному потоку взять две задачи."""
+        if self._readers is None:
+            return
+        barrier = threading.Barrier(self.engine.readers)
+
+        def each(c):
+            fn(c)
+            barrier.wait(timeout=10)
+
+        await asyncio.gather(*(self.read(each, label=fn.__name__) for _ in range(self.engine.readers)))
+
+    async def transaction(self, fn, *args, label=None):
+        """То же, что run, но fn выполняется атомарно (commit / rollback)."""
+        def tx(c, *a):
+            with c:
+                return fn(c, *a)
+        return await self.run(tx, *args, label=label or fn.__name__)
+
+    async def execute(self, sql, params=()):
+        def op(c):
+            with c:
+                return c.execute(sql, params).lastrowid
+        return await self.run(op, label=sql)
+
+    async def update(self, sql, params=()):
+        """execute, возвращающий число затронутых строк."""
+        def op(c):
+            with c:
+                return c.execute(sql, params).rowcount
+        return await self.run(op, label=sql)
+
+    async def fetchone(self, sql, params=(), fresh=False):
+        return await self.read(lambda c: c.execute(sql, params).fetchone(), label=sql, fresh=fresh)
+
+    async def fetchall(self, sql, params=(), fresh=False):
+        return await self.read(lambda c: c.execute(sql, params).fetchall(), label=sql, fresh=fresh)
+
+    async def scalar(self, sql, params=(), fresh=False):
+        row = await self.fetchone(sql, params, fresh=fresh)
+        return row[0] if row else None
+
+    async def close(self):
+        if self._readers is not None:
+            self._readers.shutdown(wait=True)
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+        if self.conn is not None:
+            await self.run(lambda c: c.close())
+            self.conn = None
+        self._executor.shutdown(wait=True)
+
+db = Database(ENGINES[DB_ENGINE](DB_PATH))
+
+# ── Миграции ───────────────────────────────────────────────────
+# Шаги применяются по порядку, каждый — один раз и в своей транзакции;
+# номер последнего применённого шага хранится в schema_version.
+# Новые изменения схемы — только новым шагом в конце списка.
+
+def _add_columns(c):
+    """Колонки, добавленные после первого релиза. Базы, созданные до появления
+    миграций, могли уже получить их через ALTER — поэтому проверяем."""
+    for table, column, decl in (
+        ("chats",    "ended_at",   "REAL DEFAULT NULL"),
+        ("messages", "created_at", "REAL DEFAULT NULL"),
+    ):
+        if column not in {r[1] for r in c.execute(f"PRAGMA table_info({table})")}:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+            if (table, column) == ("chats", "ended_at"):
+                # Старые завершённые чаты: срок хранения считаем с момента обновления
+                c.execute("UPDATE chats SET ended_at=? WHERE ended=1", (time.time(),))
+
+MIGRATIONS = [
+    (1, "base tables", (
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id       INTEGER PRIMARY KEY,
+            name          TEXT NOT NULL,
+            gender        TEXT NOT NULL,
+            age           INTEGER NOT NULL,
+            chats_count   INTEGER DEFAULT 0,
+            messages_sent INTEGER DEFAULT 0,
+            is_banned     INTEGER DEFAULT 0,
+            referred_by   INTEGER DEFAULT NULL,
+            ref_count     INTEGER DEFAULT 0,
+            rating_sum    INTEGER DEFAULT 0,
+            rating_count  INTEGER DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS chats (
+            id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            user1_id  INTEGER,
+            user2_id  INTEGER,
+            ended     INTEGER DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS messages (
+            id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id   INTEGER,
+            sender_id INTEGER,
+            display   TEXT,
+            content   TEXT,
+            ts        TEXT DEFAULT (strftime('%H:%M', 'now', 'localtime'))
+        )""",
+        """CREATE TABLE IF NOT EXISTS queue (
+            user_id INTEGER PRIMARY KEY
+        )""",
+        """CREATE TABLE IF NOT EXISTS reports (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            reporter_id INTEGER,
+            reported_id INTEGER,
+            chat_id     INTEGER,
+            status      TEXT DEFAULT 'pending'
+        )""",
+        """CREATE TABLE IF NOT EXISTS ratings (
+            id       INTEGER PRIMARY KEY AUTOINCREMENT,
+            rater_id INTEGER,
+            rated_id INTEGER,
+            chat_id  INTEGER,
+            score    INTEGER
+        )""",
+    )),
+    (2, "service tables", (
+        """CREATE TABLE IF NOT EXISTS broadcasts (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            text        TEXT NOT NULL,
+            status      TEXT DEFAULT 'running',
+            last_uid    INTEGER DEFAULT 0,
+            ok          INTEGER DEFAULT 0,
+            fail        INTEGER DEFAULT 0,
+            total       INTEGER DEFAULT 0,
+            admin_chat  INTEGER,
+            progress_id INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS fsm (
+            key        TEXT PRIMARY KEY,
+            state      TEXT,
+            data       TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS jobs (
+            name     TEXT PRIMARY KEY,
+            next_run REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS search_prefs (
+            user_id  INTEGER PRIMARY KEY,
+            gender   TEXT DEFAULT NULL,
+            age_min  INTEGER DEFAULT NULL,
+            age_max  INTEGER DEFAULT NULL
+        )""",
+    )),
+    (3, "retention timestamps", _add_columns),
+    (4, "indexes for hot queries", (
+        # Поиск чата по участнику: (user1_id=? OR user2_id=?) AND ended=0
+        "CREATE INDEX IF NOT EXISTS idx_chats_user1 ON chats(user1_id, ended)",
+        "CREATE INDEX IF NOT EXISTS idx_chats_user2 ON chats(user2_id, ended)",
+        # Открытые чаты: загрузка индекса при старте и анти-джойн промо
+        "CREATE INDEX IF NOT EXISTS idx_chats_open ON chats(user1_id, user2_id) WHERE ended=0",
+        # Очистка истёкших переписок
+        "CREATE INDEX IF NOT EXISTS idx_chats_ended_at ON chats(ended_at) WHERE ended=1",
+        # Диалог для жалобы и его постраничный просмотр (rowid входит в индекс)
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id)",
+        "CREATE INDEX IF NOT EXISTS idx_ratings_rater ON ratings(rater_id, chat_id)",
+        "CREATE INDEX IF NOT EXISTS idx_reports_reporter ON reports(reporter_id, chat_id)",
+        "CREATE INDEX IF NOT EXISTS idx_reports_pending ON reports(id) WHERE status='pending'",
+        "CREATE INDEX IF NOT EXISTS idx_users_banned ON users(is_banned)",
+    )),
+    (5, "queue presence", (
+        "ALTER TABLE queue ADD COLUMN last_seen REAL DEFAULT NULL",
+    )),
+    (6, "delivery status", (
+        """CREATE TABLE IF NOT EXISTS delivery (
+            user_id    INTEGER PRIMARY KEY,
+            status     TEXT NOT NULL,
+            last_error TEXT,
+            updated_at REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_delivery_down ON delivery(updated_at) WHERE status!='reachable'",
+    )),
+    (7, "report history", (
+        "CREATE INDEX IF NOT EXISTS idx_reports_reported ON reports(reported_id)",
+    )),
+    (8, "one rating and report per chat", (
+        # Дубли от двойных нажатий: лишние оценки вычитаются из профиля и удаляются
+        """UPDATE users SET
+             rating_sum   = rating_sum - (SELECT SUM(score) FROM ratings r WHERE r.rated_id=users.user_id
+                              AND r.id NOT IN (SELECT MIN(id) FROM ratings GROUP BY rater_id, chat_id)),
+             rating_count = rating_count - (SELECT COUNT(*) FROM ratings r WHERE r.rated_id=users.user_id
+                              AND r.id NOT IN (SELECT MIN(id) FROM ratings GROUP BY rater_id, chat_id))
+           WHERE user_id IN (SELECT rated_id FROM ratings
+                              WHERE id NOT IN (SELECT MIN(id) FROM ratings GROUP BY rater_id, chat_id))""",
+        "DELETE FROM ratings WHERE id NOT IN (SELECT MIN(id) FROM ratings GROUP BY rater_id, chat_id)",
+        "DELETE FROM reports WHERE id NOT IN (SELECT MIN(id) FROM reports GROUP BY reporter_id, chat_id)",
+        "DROP INDEX IF EXISTS idx_ratings_rater",
+        "DROP INDEX IF EXISTS idx_reports_reporter",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_ratings_rater ON ratings(rater_id, chat_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_reports_reporter ON reports(reporter_id, chat_id)",
+    )),
+    (9, "age filter within own age group", (
+        # Сохранённый фильтр по чужой возрастной группе сбрасывается на «любой»
+        """UPDATE search_prefs SET age_min=NULL, age_max=NULL
+           WHERE age_min IS NOT NULL AND user_id IN (
+             SELECT p.user_id FROM search_prefs p JOIN users u ON u.user_id=p.user_id
+             WHERE (u.age < 18) != (p.age_max < 18))""",
+    )),
+]
+
+def migrate(c, target=None):
+    """Довести схему до версии target (по умолчанию — до последней)."""
+    c.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    current = c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    for version, name, step in MIGRATIONS:
+        if version <= current or (target is not None and version > target):
+            continue
+        t0 = time.perf_counter()
+        c.execute("BEGIN")
+        try:
+            if callable(step):
+                step(c)
+            else:
+                for sql in step:
+                    c.execute(sql)
+            c.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+            c.commit()
+        except Exception:
+            c.rollback()
+            raise
+        logger.info(f"Migration {version} ({name}) applied in {time.perf_counter() - t0:.2f}s")
+    return c.execute("SELECT MAX(version) FROM schema_version").fetchone()[0]
+
+async def init_db():
+    version = await db.run(migrate)
+    logger.info(f"Schema version {version}")
+
+# ── FSM-хранилище ───────────────────────────────────────────────
+FSM_FLUSH_S   = float(os.environ.get("FSM_FLUSH_S", "1"))    # 0 — писать сразу, без кэша
+FSM_REG_TTL   = int(os.environ.get("FSM_REG_TTL", str(24 * 60 * 60)))
+FSM_IDLE_EVICT = 60 * 60
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm с write-back кэшем в памяти.
+
+    Чтение — из кэша, запись — в кэш с пометкой «грязный»; фоновая задача
+    раз в flush_s секунд сбрасывает грязные ключи одной транзакцией.
+    Незаконченная регистрация (Reg:*) старше reg_ttl удаляется.
+
+    Кэш у каждого процесса свой. Несколько воркеров могут делить одну
+    таблицу, если апдейты пользователя всегда попадают в один процесс,
+    либо при flush_s=0: тогда каждая запись сразу идёт в БД, а чтение
+    всегда из БД."""
+
+    def __init__(self, db, flush_s=FSM_FLUSH_S, reg_ttl=FSM_REG_TTL):
+        self.db       = db
+        self.flush_s  = flush_s
+        self.reg_ttl  = reg_ttl
+        self._keys    = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache   = {}      # key → [state, data, updated_at]
+        self._dirty   = set()
+        self._task    = None
+
+    async def preload(self):
+        """Поднять в кэш недавно тронутые ключи — их мало: пустые удаляются."""
+        if not self.flush_s:
+            return 0
+        rows = await self.db.fetchall(
+            "SELECT key, state, data, updated_at FROM fsm WHERE updated_at>?", (time.time() - FSM_IDLE_EVICT,)
+        )
+        for r in rows:
+            self._cache.setdefault(r["key"], [r["state"], json.loads(r["data"]), r["updated_at"]])
+        return len(rows)
+
+    async def _load(self, k):
+        entry = self._cache.get(k) if self.flush_s else None
+        if entry is None:
+            row = await self.db.fetchone("SELECT state, data, updated_at FROM fsm WHERE key=?", (k,))
+            entry = [row["state"], json.loads(row["data"]), row["updated_at"]] if row else [None, {}, time.time()]
+            if self.flush_s:
+                # Пока шёл запрос, параллельный апдейт мог загрузить ключ и
+                # уже сменить состояние — его запись главнее прочитанной
+                entry = self._cache.setdefault(k, entry)
+        return entry
+
+    async def _store(self, k, entry):
+        entry[2] = time.time()
+        if self.flush_s:
+            self._cache[k] = entry
+            self._dirty.add(k)
+        else:
+            await self.db.run(self._write, [(k, entry)], label="fsm_write")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._keys.build(key)
+        entry = list(await self._load(k))
+        entry[0] = state.state if isinstance(state, State) else state
+        await self._store(k, entry)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._load(self._keys.build(key)))[0]
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        k = self._keys.build(key)
+        entry = list(await self._load(k))
+        entry[1] = dict(data)
+        await self._store(k, entry)
+
+    async def get_data(self, key: StorageKey):
+        return dict((await self._load(self._keys.build(key)))[1])
+
+    @staticmethod
+    def _write(c, items):
+        with c:
+            for k, (state, data, ts) in items:
+                if state is None and not data:
+                    c.execute("DELETE FROM fsm WHERE key=?", (k,))
+                else:
+                    c.execute(
+                        "INSERT INTO fsm (key,state,data,updated_at) VALUES (?,?,?,?) "
+                        "ON CONFLICT(key) DO UPDATE SET state=excluded.state, "
+                        "data=excluded.data, updated_at=excluded.updated_at",
+                        (k, state, json.dumps(data, ensure_ascii=False), ts)
+                    )
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        items = [(k, self._cache[k]) for k in keys if k in self._cache]
+        try:
+            await self.db.run(self._write, items, label="fsm_flush")
+        except Exception:
+            self._dirty |= keys
+            raise
+
+    async def expire(self):
+        """Удалить брошенные регистрации и выгрузить давно не тронутые ключи."""
+        now = time.time()
+        for k, (state, data, ts) in list(self._cache.items()):
+            if state and state.startswith("Reg:") and now - ts > self.reg_ttl:
+                self._cache[k] = [None, {}, now]
+                self._dirty.add(k)
+            elif k not in self._dirty and now - ts > FSM_IDLE_EVICT:
+                del self._cache[k]
+        await self.db.execute(
+            "DELETE FROM fsm WHERE state LIKE 'Reg:%' AND updated_at<?", (now - self.reg_ttl,)
+        )
+
+    async def _run(self):
+        last_expire = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_s or 60)
+            try:
+                await self.flush()
+                if time.monotonic() - last_expire > 60:
+                    last_expire = time.monotonic()
+                    await self.expire()
+            except Exception as e:
+                logger.error(f"FSM storage flush error: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+fsm_storage = SQLiteStorage(db)
+
+# ── Реплика для чтения ─────────────────────────────────────────
+# Админка и аналитика читают копию базы, а не живой файл: тяжёлые
+# агрегаты не конкурируют с пересылкой за I/O и page cache.
+REPLICA_PATH    = os.environ.get("REPLICA_PATH", f"{DB_PATH}.replica" if DB_ENGINE == "sqlite" else "")
+REPLICA_EVERY_S = int(os.environ.get("REPLICA_EVERY_S", "300"))
+REPLICA_PAGES   = 256     # страниц за шаг backup
+REPLICA_PAUSE_S = 0.005   # пауза между шагами
+
+class Replica:
+    """Периодический онлайн-снимок базы через backup API.
+
+    Копирование идёт шагами по REPLICA_PAGES страниц с паузой
+    REPLICA_PAUSE_S между ними (отдаём диск и GIL остальным) с отдельного
+    соединения, которое держит одну транзакцию чтения: в WAL это не мешает
+    писателю, а снимок согласован и не перезапускается от чужих записей.
+    Готовый файл подменяется атомарно (os.replace).
+
+    Данные реплики не старше REPLICA_EVERY_S плюс время копирования. Если
+    снимок старше двух интервалов (копирование падает) или реплика
+    выключена, read() читает из живой базы."""
+
+    def __init__(self, db, path, every_s):
+        self.db       = db
+        self.path     = path
+        self.every_s  = every_s
+        self.taken_at = None   # момент, на который согласован снимок
+        self._copier  = ThreadPoolExecutor(max_workers=1, thread_name_prefix="replica-copy")
+        self._reader  = ThreadPoolExecutor(max_workers=1, thread_name_prefix="replica-read")
+        self._conn    = None
+        self._conn_at = None
+
+    def _snapshot(self):
+        tmp = self.path + ".tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        src = self.db.engine.connect(readonly=True)
+        dst = sqlite3.connect(tmp)
+        try:
+            src.execute("BEGIN")
+            src.execute("SELECT 1 FROM sqlite_master LIMIT 1")   # фиксирует снимок WAL
+            taken_at = time.time()
+            # sleep= у backup срабатывает только на BUSY, которого в WAL не бывает,
+            # поэтому пауза между шагами делается из progress
+            src.backup(dst, pages=REPLICA_PAGES, progress=lambda *_: time.sleep(REPLICA_PAUSE_S))
+            src.rollback()
+            dst.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            dst.close()
+            src.close()
+        os.replace(tmp, self.path)
+        return taken_at
+
+    async def refresh(self):
+        loop = asyncio.get_running_loop()
+        with DB_SECONDS.time("replica_snapshot"):
+            self.taken_at = await loop.run_in_executor(self._copier, self._snapshot)
+
+    def age(self):
+        return time.time() - self.taken_at if self.taken_at else None
+
+    def usable(self):
+        age = self.age()
+        return bool(self.path) and age is not None and age < 2 * self.every_s
+
+    def _read_call(self, fn, args):
+        if self._conn_at != self.taken_at:
+            if self._conn is not None:
+                self._conn.close()
+            uri = pathlib.Path(self.path).absolute().as_uri() + "?mode=ro&immutable=1"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn_at = self.taken_at
+        return fn(self._conn, *args)
+
+    async def read(self, fn, *args):
+        """fn(conn, *args) на реплике или, если она не годится, на живой базе."""
+        if not self.usable():
+            return await self.db.read(fn, *args)
+        loop = asyncio.get_running_loop()
+        with DB_SECONDS.time(f"replica:{fn.__name__}"):
+            return await loop.run_in_executor(self._reader, self._read_call, fn, args)
+
+    def freshness(self):
+        """Подпись к данным с реплики."""
+        if not self.usable():
+            return "<i>🕒 Живые данные</i>"
+        return (f"<i>🕒 Снимок на {time.strftime('%H:%M:%S', time.localtime(self.taken_at))}, "
+                f"обновляется каждые {max(1, self.every_s // 60)} мин.</i>")
+
+    async def close(self):
+        self._copier.shutdown(wait=True)
+        self._reader.shutdown(wait=True)
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+replica = Replica(db, REPLICA_PATH, REPLICA_EVERY_S)
+
+async def replica_loop():
+    if not REPLICA_PATH:
+        return
+    while True:
+        t0 = time.perf_counter()
+        try:
+            await replica.refresh()
+            logger.info(f"Replica snapshot in {time.perf_counter() - t0:.2f}s "
+                        f"({os.path.getsize(REPLICA_PATH) / 2**20:.1f} MB)")
+        except Exception as e:
+            logger.error(f"Replica snapshot error: {e}")
+        await asyncio.sleep(REPLICA_EVERY_S)
 
 # ═══════════════════════════════════════════════════════════════
 #  ХЕЛПЕРЫ
 # ═══════════════════════════════════════════════════════════════
 
-def get_user(uid):
-    return conn.execute("SELECT * FROM users WHERE user_id=?", (uid,)).fetchone()
-
-def is_banned(uid):
-    u = get_user(uid)
+_tasks = set()
+
+def spawn(coro):
+    """create_task с удержанием ссылки, чтобы задачу не собрал GC."""
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+# ── Кэш профилей ────────────────────────────────────────────────
+class UserCache:
+    """LRU-кэш строк users вместе с готовой строкой user_display.
+    Кэшируется и отсутствие пользователя (None), поэтому любой код,
+    меняющий users, обязан вызвать invalidate() или bump()."""
+
+    def __init__(self, maxsize=50_000):
+        self.maxsize = maxsize
+        self.hits    = 0
+        self.misses  = 0
+        self._data   = OrderedDict()   # uid → [row | None, display | None]
+        self._gen    = 0               # растёт при каждом изменении
+
+    def get(self, uid):
+        entry = self._data.get(uid)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self._data.move_to_end(uid)
+        self.hits += 1
+        return True, entry[0]
+
+    def put(self, uid, row, gen):
+        # Если за время запроса к БД кого-то поменяли — не кладём
+        # возможно устаревшую строку
+        if gen != self._gen:
+            return
+        self._data[uid] = [row, None]
+        self._data.move_to_end(uid)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    @property
+    def generation(self):
+        return self._gen
+
+    def invalidate(self, *uids):
+        self._gen += 1
+        for uid in uids:
+            self._data.pop(uid, None)
+
+    def bump(self, uid, **deltas):
+        """Применить счётчики (chats_count=+1 …) к закэшированной строке."""
+        self._gen += 1
+        entry = self._data.get(uid)
+        if entry and entry[0] is not None:
+            row = dict(entry[0])
+            for k, v in deltas.items():
+                row[k] += v
+            entry[0] = row
+
+    def display(self, u):
+        entry = self._data.get(u["user_id"])
+        return entry[1] if entry and entry[0] is u else None
+
+    def set_display(self, u, text):
+        entry = self._data.get(u["user_id"])
+        if entry and entry[0] is u:
+            entry[1] = text
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+user_cache = UserCache(int(os.environ.get("USER_CACHE_SIZE", "50000")))
+
+async def get_user(uid):
+    hit, u = user_cache.get(uid)
+    if hit:
+        return u
+    gen = user_cache.generation
+    # fresh: порядок с записью счётчиков (UserCounters.flush) важен для точных цифр
+    row = await db.fetchone("SELECT * FROM users WHERE user_id=?", (uid,), fresh=True)
+    u = dict(row) if row else None
+    user_cache.put(uid, u, gen)
+    return u
+
+async def is_banned(uid):
+    u = await get_user(uid)
     return bool(u and u["is_banned"])
 
+# ── Счётчики профиля ────────────────────────────────────────────
+COUNTERS_FLUSH_S = float(os.environ.get("COUNTERS_FLUSH_S", "5"))
+
+class UserCounters:
+    """Отложенная запись chats_count / messages_sent: приращения копятся
+    в памяти и раз в interval секунд пишутся одним executemany.
+    Строка users в БД и в кэше отстаёт на pending(uid) — показывать
+    нужно сумму, см. with_pending()."""
+
+    FIELDS = ("chats_count", "messages_sent")
+
+    def __init__(self, db, interval=COUNTERS_FLUSH_S):
+        self.db       = db
+        self.interval = interval
+        self._pending = {}   # uid → [chats_count, messages_sent]
+        self._flying  = {}   # пачка, которая пишется прямо сейчас
+        self._lock    = asyncio.Lock()
+        self._task    = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, uid, chats_count=0, messages_sent=0):
+        d = self._pending.setdefault(uid, [0, 0])
+        d[0] += chats_count
+        d[1] += messages_sent
+
+    def pending(self, uid):
+        a = self._pending.get(uid, (0, 0))
+        b = self._flying.get(uid, (0, 0))
+        return {"chats_count": a[0] + b[0], "messages_sent": a[1] + b[1]}
+
+    def with_pending(self, u):
+        """Копия строки users с ещё не записанными приращениями."""
+        u = dict(u)
+        for k, v in self.pending(u["user_id"]).items():
+            u[k] += v
+        return u
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            self._flying, self._pending = self._pending, {}
+            batch = [(ch, ms, uid) for uid, (ch, ms) in self._flying.items()]
+
+            def write(c):
+                with c:
+                    c.executemany(
+                        "UPDATE users SET chats_count=chats_count+?, messages_sent=messages_sent+? "
+                        "WHERE user_id=?", batch
+                    )
+            try:
+                await self.db.run(write, label="counters_flush")
+            except Exception:
+                for uid, (ch, ms) in self._flying.items():
+                    self.add(uid, ch, ms)
+                raise
+            else:
+                # Пачка уже в БД — переносим её в закэшированные строки
+                for uid, (ch, ms) in self._flying.items():
+                    user_cache.bump(uid, chats_count=ch, messages_sent=ms)
+            finally:
+                self._flying = {}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"User counters flush error: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+counters = UserCounters(db)
+
+# ── Индекс активных чатов: user_id → (partner_id, chat_id) ─────
+# Держим в памяти, чтобы relay не сканировал таблицу chats на каждое
+# сообщение. Источник истины — chats WHERE ended=0, индекс строится при
+# старте и обновляется только через open_chat / close_chat.
+active_chats: dict[int, tuple[int, int]] = {}
+_chat_seq = itertools.count(1)
+
+async def load_active_chats():
+    global _chat_seq
+    active_chats.clear()
+    for r in await db.fetchall("SELECT id, user1_id, user2_id FROM chats WHERE ended=0 ORDER BY id"):
+        active_chats[r["user1_id"]] = (r["user2_id"], r["id"])
+        active_chats[r["user2_id"]] = (r["user1_id"], r["id"])
+    _chat_seq = itertools.count((await db.scalar("SELECT MAX(id) FROM chats") or 0) + 1)
+    logger.info(f"Active chats loaded: {len(active_chats) // 2}")
+
+def next_chat_id():
+    """id чата выдаётся в памяти, чтобы пару можно было создать без await."""
+    return next(_chat_seq)
+
+def open_chat(uid, pid, chat_id):
+    active_chats[uid] = (pid, chat_id)
+    active_chats[pid] = (uid, chat_id)
+
+def claim_chat(uid, pid):
+    """Занять пару сразу после match(), без await: с этого момента оба в
+    active_chats, и ни поиск, ни пул их уже не возьмут."""
+    chat_id = next_chat_id()
+    open_chat(uid, pid, chat_id)
+    return chat_id
+
+def close_chat(uid):
+    entry = active_chats.pop(uid, None)
+    if entry:
+        pid, chat_id = entry
+        if active_chats.get(pid, (None, None))[1] == chat_id:
+            del active_chats[pid]
+    return entry
+
 def get_partner(uid):
-    row = conn.execute(
-        "SELECT CASE WHEN user1_id=? THEN user2_id ELSE user1_id END as p "
-        "FROM chats WHERE (user1_id=? OR user2_id=?) AND ended=0 LIMIT 1",
-        (uid, uid, uid)
-    ).fetchone()
-    return row["p"] if row else None
+    entry = active_chats.get(uid)
+    return entry[0] if entry else None
 
 def get_active_chat_id(uid):
-    row = conn.execute(
-        "SELECT id FROM chats WHERE (user1_id=? OR user2_id=?) AND ended=0 LIMIT 1",
-        (uid, uid)
-    ).fetchone()
-    return row["id"] if row else None
+    entry = active_chats.get(uid)
+    return entry[1] if entry else None
+
+# ── Подбор собеседника ──────────────────────────────────────────
+AGE_BAND          = 5                                            # ширина возрастной корзины, лет
+MATCH_RELAX_AFTER = int(os.environ.get("MATCH_RELAX_AFTER", "60"))  # сек. до снятия фильтров
+MATCH_SCAN_LIMIT  = 32                                           # сколько смотреть в одной корзине
+QUEUE_TTL         = int(os.environ.get("QUEUE_TTL", "900"))      # сек. без активности до снятия с поиска
+QUEUE_SWEEP_S     = 60
+
+# Готовые диапазоны возраста для фильтра поиска: ключ → (min, max)
+AGE_RANGES = {
+    "any":   (None, None),
+    "13_17": (13, 17),
+    "18_24": (18, 24),
+    "25_34": (25, 34),
+    "35_99": (35, 99),
+}
+
+# Несовершеннолетние подбираются только друг с другом, взрослые — только
+# со взрослыми. Ни фильтр, ни снятие фильтров по таймауту этого не меняют.
+ADULT_AGE = 18
+
+def age_ranges_for(age):
+    """Диапазоны фильтра, доступные человеку этого возраста."""
+    if age < ADULT_AGE:
+        return ("any", "13_17")
+    return ("any", "18_24", "25_34", "35_99")
+
+class Seeker:
+    """Ожидающий в пуле: кто он и кого ищет."""
+    __slots__ = ("uid", "gender", "age", "want_gender", "age_min", "age_max", "since", "last_seen")
+
+    def __init__(self, uid, gender, age, want_gender=None, age_min=None, age_max=None, last_seen=None):
+        self.uid         = uid
+        self.gender      = gender
+        self.age         = age
+        self.want_gender = want_gender
+        self.age_min     = age_min
+        self.age_max     = age_max
+        self.since       = time.monotonic()
+        self.last_seen   = last_seen or time.time()   # последний апдейт от человека
+
+    def relaxed(self, now):
+        return now - self.since >= MATCH_RELAX_AFTER
+
+    def accepts(self, other, now):
+        if (self.age < ADULT_AGE) != (other.age < ADULT_AGE):
+            return False
+        if self.relaxed(now):
+            return True
+        if self.want_gender and other.gender != self.want_gender:
+            return False
+        if self.age_min and other.age < self.age_min:
+            return False
+        if self.age_max and other.age > self.age_max:
+            return False
+        return True
+
+class Matchmaker:
+    """Пул ожидающих в памяти, разложенный по корзинам (пол, возраст // AGE_BAND).
+    Таблица queue — только журнал для восстановления после рестарта.
+
+    Поиск пары — просмотр голов подходящих корзин, а не всей очереди.
+    Фильтр должен устраивать обе стороны; через MATCH_RELAX_AFTER секунд
+    ожидания фильтры человека снимаются.
+
+    match() и add() меняют пул синхронно, без await, поэтому два
+    одновременных поиска не могут забрать одного и того же человека.
+    lock(uid) сериализует действия одного пользователя (двойное нажатие
+    «Найти чат», поиск во время выхода).
+
+    Любой апдейт от ожидающего — touch(); кто молчит дольше QUEUE_TTL,
+    снимается с поиска в expire(), чтобы не сводить живых с ушедшими."""
+
+    def __init__(self, db):
+        self.db       = db
+        self._all     = {}      # uid → Seeker, в порядке прихода
+        self._buckets = {}      # (gender, band) → OrderedDict[uid, Seeker]
+        self._locks   = weakref.WeakValueDictionary()
+        self._touched = set()   # last_seen изменился, но ещё не записан в queue
+
+    def __contains__(self, uid):
+        return uid in self._all
+
+    def __len__(self):
+        return len(self._all)
+
+    def __iter__(self):
+        return iter(list(self._all))
+
+    def lock(self, uid):
+        lock = self._locks.get(uid)
+        if lock is None:
+            lock = self._locks[uid] = asyncio.Lock()
+        return lock
+
+    async def load(self):
+        rows = await self.db.fetchall(
+            "SELECT q.user_id, q.last_seen, u.gender, u.age, p.gender AS want_gender, p.age_min, p.age_max "
+            "FROM queue q JOIN users u ON u.user_id=q.user_id "
+            "LEFT JOIN search_prefs p ON p.user_id=q.user_id"
+        )
+        self._all.clear()
+        self._buckets.clear()
+        for r in rows:
+            if r["user_id"] not in active_chats:
+                self._insert(Seeker(r["user_id"], r["gender"], r["age"],
+                                    r["want_gender"], r["age_min"], r["age_max"], r["last_seen"]))
+        logger.info(f"Queue loaded: {len(self._all)}")
+
+    def _insert(self, s):
+        self._all[s.uid] = s
+        self._buckets.setdefault((s.gender, s.age // AGE_BAND), OrderedDict())[s.uid] = s
+
+    def _discard(self, uid):
+        s = self._all.pop(uid, None)
+        if s is None:
+            return False
+        key = (s.gender, s.age // AGE_BAND)
+        bucket = self._buckets[key]
+        del bucket[uid]
+        if not bucket:
+            del self._buckets[key]
+        return True
+
+    def _candidate_keys(self, s, now):
+        # Корзины по другую сторону ADULT_AGE не смотрим вовсе
+        if s.age < ADULT_AGE:
+            lo, hi = 0, (ADULT_AGE - 1) // AGE_BAND
+        else:
+            lo, hi = ADULT_AGE // AGE_BAND, 999
+        want = None
+        if not s.relaxed(now):
+            lo   = max(lo, (s.age_min or 0) // AGE_BAND)
+            hi   = min(hi, (s.age_max or 999) // AGE_BAND)
+            want = s.want_gender
+        return [k for k in self._buckets if (not want or k[0] == want) and lo <= k[1] <= hi]
+
+    def match(self, s):
+        """Забрать из пула самого давнего ожидающего, подходящего s."""
+        now  = time.monotonic()
+        best = None
+        for key in self._candidate_keys(s, now):
+            for i, c in enumerate(self._buckets[key].values()):
+                if i >= MATCH_SCAN_LIMIT:
+                    break
+                if c.uid != s.uid and s.accepts(c, now) and c.accepts(s, now):
+                    if best is None or c.since < best.since:
+                        best = c
+                    break
+        if best is None:
+            return None
+        self._discard(best.uid)
+        return best.uid
+
+    def relaxed_pairs(self):
+        """Пары (uid, pid, chat_id) среди тех, кто ждёт дольше MATCH_RELAX_AFTER.
+        Каждая пара занимается тут же (claim_chat), до возврата."""
+        now, pairs = time.monotonic(), []
+        for s in list(self._all.values()):
+            if not s.relaxed(now):
+                break   # _all упорядочен по времени прихода
+            if s.uid not in self._all:
+                continue
+            pid = self.match(s)
+            if pid:
+                self._discard(s.uid)
+                pairs.append((s.uid, pid, claim_chat(s.uid, pid)))
+        return pairs
+
+    async def add(self, s):
+        self._insert(s)
+        await self.db.execute(
+            "INSERT OR REPLACE INTO queue (user_id,last_seen) VALUES (?,?)", (s.uid, s.last_seen)
+        )
 
-def in_queue(uid):
-    return conn.execute("SELECT 1 FROM queue WHERE user_id=?", (uid,)).fetchone() is not None
+    def restore(self, s):
+        """Вернуть в пул без записи: строку queue вызывающий пишет сам."""
+        self._insert(s)
+
+    async def remove(self, uid):
+        if not self._discard(uid):
+            return False
+        self._touched.discard(uid)
+        await self.db.execute("DELETE FROM queue WHERE user_id=?", (uid,))
+        return True
+
+    def touch(self, uid):
+        s = self._all.get(uid)
+        if s is not None:
+            s.last_seen = time.time()
+            self._touched.add(uid)
+
+    async def expire(self, ttl):
+        """Снять с поиска молчащих дольше ttl; заодно записать свежие last_seen."""
+        deadline = time.time() - ttl
+        stale    = [s.uid for s in self._all.values() if s.last_seen < deadline]
+        for uid in stale:
+            self._discard(uid)
+        seen = [(self._all[uid].last_seen, uid) for uid in self._touched if uid in self._all]
+        self._touched.clear()
+        if stale or seen:
+            def write(c):
+                with c:
+                    c.executemany("DELETE FROM queue WHERE user_id=?", [(uid,) for uid in stale])
+                    c.executemany("UPDATE queue SET last_seen=? WHERE user_id=?", seen)
+            await self.db.run(write, label="queue_presence")
+        return stale
+
+matchmaker = Matchmaker(db)
 
-def save_msg(chat_id, sender_id, display, content):
-    conn.execute(
-        "INSERT INTO messages (chat_id,sender_id,display,content) VALUES (?,?,?,?)",
-        (chat_id, sender_id, display, content)
+def in_queue(uid):
+    return uid in matchmaker
+
+async def presence(handler, event, data):
+    """Middleware роутера: любой апдейт ожидающего продлевает его поиск,
+    а апдейт от помеченного недоступным значит, что он снова на связи."""
+    uid = event.from_user.id
+    matchmaker.touch(uid)
+    if not delivery.is_reachable(uid):
+        await delivery.recovered(uid)
+    return await handler(event, data)
+
+async def get_prefs(uid):
+    row = await db.fetchone("SELECT gender, age_min, age_max FROM search_prefs WHERE user_id=?", (uid,))
+    return (row["gender"], row["age_min"], row["age_max"]) if row else (None, None, None)
+
+async def set_prefs(uid, gender, age_min, age_max):
+    await db.execute(
+        "INSERT INTO search_prefs (user_id,gender,age_min,age_max) VALUES (?,?,?,?) "
+        "ON CONFLICT(user_id) DO UPDATE SET gender=excluded.gender, "
+        "age_min=excluded.age_min, age_max=excluded.age_max",
+        (uid, gender, age_min, age_max)
     )
-    conn.commit()
 
-def format_dialog(chat_id):
-    rows = conn.execute(
-        "SELECT display, content, ts FROM messages WHERE chat_id=? ORDER BY id",
-        (chat_id,)
+# ── Журнал сообщений с групповым коммитом ───────────────────────
+class MessageLog:
+    """Буфер журнала переписки: строки копятся в памяти и пишутся одной
+    транзакцией каждые max_batch строк или каждые interval секунд."""
+
+    def __init__(self, db, max_batch=100, interval=0.5):
+        self.db        = db
+        self.max_batch = max_batch
+        self.interval  = interval
+        self._buf      = []
+        self._wake     = asyncio.Event()
+        self._lock     = asyncio.Lock()
+        self._task     = None
+
+    def add(self, chat_id, sender_id, display, content):
+        # Время фиксируем при отправке, а не при записи пачки
+        now = time.time()
+        self._buf.append((chat_id, sender_id, display, content, time.strftime("%H:%M", time.localtime(now)), now))
+        if len(self._buf) >= self.max_batch:
+            self._wake.set()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._buf:
+                return
+            batch, self._buf = self._buf, []
+
+            def write(c):
+                with c:
+                    c.executemany(
+                        "INSERT INTO messages (chat_id,sender_id,display,content,ts,created_at) VALUES (?,?,?,?,?,?)",
+                        batch
+                    )
+            try:
+                await self.db.run(write, label="message_log_flush")
+            except Exception:
+                self._buf[:0] = batch
+                raise
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Message log flush error: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+msg_log = MessageLog(
+    db,
+    max_batch=int(os.environ.get("MSG_FLUSH_SIZE", "100")),
+    interval=int(os.environ.get("MSG_FLUSH_MS", "500")) / 1000,
+)
+
+async def end_chat_record(chat_id):
+    await db.execute("UPDATE chats SET ended=1, ended_at=? WHERE id=?", (time.time(), chat_id))
+
+# ── Хранение и архив переписки ──────────────────────────────────
+RETENTION_DAYS  = int(os.environ.get("RETENTION_DAYS", "30"))   # после завершения чата
+ARCHIVE_DIR     = os.environ.get("ARCHIVE_DIR", "archive")
+COMPACT_BATCH   = 1000
+COMPACT_CHATS   = 200     # просроченных чатов за одну выборку
+COMPACT_EVERY_S = 60 * 60
+
+# Сжатие и запись архива — в своём потоке: писатель БД занят только DELETE
+_archive_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
+
+def _expired_chats(c, after, cutoff):
+    """Следующие COMPACT_CHATS чатов с ended_at<cutoff после курсора
+    (ended_at, id) — диапазон по idx_chats_ended_at, без скана messages."""
+    return c.execute(
+        "SELECT ended_at, id FROM chats WHERE ended=1 AND ended_at<? AND (ended_at, id)>(?, ?) "
+        "ORDER BY ended_at, id LIMIT ?",
+        (cutoff, *after, COMPACT_CHATS)
+    ).fetchall()
+
+def _expired_batch(c, chat_ids):
+    rows = c.execute(
+        "SELECT m.id, m.chat_id, m.sender_id, m.display, m.content, m.ts, "
+        "       COALESCE(m.created_at, ch.ended_at) AS created_at "
+        "FROM messages m JOIN chats ch ON ch.id=m.chat_id "
+        f"WHERE m.chat_id IN ({','.join('?' * len(chat_ids))}) LIMIT ?",
+        (*chat_ids, COMPACT_BATCH)
     ).fetchall()
+    return [dict(r) for r in rows]
+
+def _write_archive(rows):
+    by_day = {}
+    for r in rows:
+        day = time.strftime("%Y-%m-%d", time.localtime(r["created_at"]))
+        by_day.setdefault(day, []).append(json.dumps(r, ensure_ascii=False))
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for day, lines in by_day.items():
+        # Дописывание в gzip создаёт новый член архива — gzip.open читает их подряд
+        with gzip.open(os.path.join(ARCHIVE_DIR, f"messages-{day}.jsonl.gz"), "at", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+async def _archive_batch(chat_ids):
+    """Одна порция: прочитать до COMPACT_BATCH строк этих чатов (читатель),
+    дописать их в gzip-архивы по дням (поток архива) и удалить короткой
+    транзакцией (писатель). Падение между записью архива и удалением даст
+    дубль в архиве, но не потерю."""
+    rows = await db.read(_expired_batch, chat_ids)
     if not rows:
-        return "(диалог пуст)"
-    return "\n".join(f"[{r['ts']}] {r['display']}: {r['content']}" for r in rows)
+        return 0
+    await asyncio.get_running_loop().run_in_executor(_archive_pool, _write_archive, rows)
+    await db.transaction(
+        lambda c: c.executemany("DELETE FROM messages WHERE id=?", [(r["id"],) for r in rows]),
+        label="archive_delete"
+    )
+    return len(rows)
+
+async def compact_messages():
+    """Чаты, завершённые раньше водяного знака (compact_watermark в jobs),
+    уже разобраны: проход смотрит только [знак, cutoff) и в конце двигает
+    знак на cutoff. Прерванный проход знак не двигает и будет повторён."""
+    cutoff = time.time() - RETENTION_DAYS * 24 * 60 * 60
+    after  = (await get_job_time("compact_watermark") or 0, 0)
+    total  = 0
+    while chats := await db.read(_expired_chats, after, cutoff):
+        chat_ids = [r["id"] for r in chats]
+        while True:
+            n = await _archive_batch(chat_ids)
+            total += n
+            if n < COMPACT_BATCH:
+                break
+            await asyncio.sleep(0.1)   # даём пройти запросам хэндлеров между порциями
+        after = (chats[-1]["ended_at"], chats[-1]["id"])
+    await set_job_time("compact_watermark", cutoff)
+    if total:
+        logger.info(f"Archived {total} messages older than {RETENTION_DAYS}d")
+    return total
+
+async def compaction_loop():
+    while True:
+        try:
+            await compact_messages()
+        except Exception as e:
+            logger.error(f"Compaction error: {e}")
+        await asyncio.sleep(COMPACT_EVERY_S)
 
-def avg_rating(uid):
-    u = get_user(uid)
+def save_msg(chat_id, sender_id, display, content):
+    msg_log.add(chat_id, sender_id, display, content)
+
+# ── Переписка для жалоб ─────────────────────────────────────────
+DIALOG_PAGE     = 30    # строк в сообщении админу
+DIALOG_LINE_MAX = 100   # длиннее — обрезаем (полный текст есть в файле)
+
+def _dialog_line(r):
+    return f"[{r['ts']}] {r['display']}: {r['content']}"
+
+def render_dialog(rows):
+    """Строки для вставки в <code>: обрезанные и экранированные, чтобы
+    страница гарантированно влезла в лимит Telegram в 4096 символов."""
+    if not rows:
+        return "(диалог пуст)"
+    lines = []
+    for r in rows:
+        line = _dialog_line(r)
+        if len(line) > DIALOG_LINE_MAX:
+            line = line[:DIALOG_LINE_MAX - 1] + "…"
+        lines.append(html.escape(line))
+    return "\n".join(lines)
+
+async def dialog_page(chat_id, before=None, after=None):
+    """Страница из DIALOG_PAGE строк по ключу messages.id: последние строки,
+    строки до before или после after. Возвращает (rows, есть_раньше, есть_позже)."""
+    await msg_log.flush()  # жалоба должна видеть и ещё не записанные строки
+
+    def page(c):
+        if after is not None:
+            rows = c.execute(
+                "SELECT id, display, content, ts FROM messages WHERE chat_id=? AND id>? ORDER BY id LIMIT ?",
+                (chat_id, after, DIALOG_PAGE)
+            ).fetchall()
+        else:
+            rows = c.execute(
+                "SELECT id, display, content, ts FROM messages WHERE chat_id=? AND id<? ORDER BY id DESC LIMIT ?",
+                (chat_id, before if before is not None else 2 ** 63 - 1, DIALOG_PAGE)
+            ).fetchall()[::-1]
+        if not rows:
+            return rows, False, False
+        older = c.execute("SELECT 1 FROM messages WHERE chat_id=? AND id<? LIMIT 1",
+                          (chat_id, rows[0]["id"])).fetchone() is not None
+        newer = c.execute("SELECT 1 FROM messages WHERE chat_id=? AND id>? LIMIT 1",
+                          (chat_id, rows[-1]["id"])).fetchone() is not None
+        return rows, older, newer
+
+    return await db.read(page, label="dialog_page")
+
+async def dialog_file(chat_id):
+    """Полный диалог во временный файл — построчно с курсора, без fetchall."""
+    await msg_log.flush()
+
+    def dump(c):
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt", delete=False) as f:
+            for r in c.execute("SELECT display, content, ts FROM messages WHERE chat_id=? ORDER BY id", (chat_id,)):
+                f.write(_dialog_line(r) + "\n")
+            return f.name
+
+    return await db.read(dump, label="dialog_file")
+
+async def avg_rating(uid):
+    u = await get_user(uid)
     if not u or u["rating_count"] == 0:
         return "нет оценок"
     return f"{u['rating_sum']/u['rating_count']:.1f} ⭐ ({u['rating_count']} оценок)"
 
 def user_display(u) -> str:
     """Красивое отображение пользователя: Имя, пол-иконка, возраст"""
-    icon = "👦" if u["gender"] == "М" else "👧"
-    return f"{u['name']} {icon} {u['age']} лет"
+    text = user_cache.display(u)
+    if text is None:
+        icon = "👦" if u["gender"] == "М" else "👧"
+        text = f"{u['name']} {icon} {u['age']} лет"
+        user_cache.set_display(u, text)
+    return text
+
+# ── Доступность получателей ─────────────────────────────────────
+DELIVERY_REPROBE_DAYS = float(os.environ.get("DELIVERY_REPROBE_DAYS", "0"))   # 0 — не перепроверять
+DELIVERY_REPROBE_BATCH = 200
+
+# Условие для запросов рассылок: пользователь u не помечен недоступным
+REACHABLE_SQL = "NOT EXISTS (SELECT 1 FROM delivery d WHERE d.user_id=u.user_id AND d.status!='reachable')"
+
+class DeliveryStatus:
+    """Кому нельзя доставить сообщение: blocked — заблокировал бота,
+    deactivated — аккаунт удалён. Статус ставится по типу ошибки API и
+    снимается, как только от человека приходит апдейт (или успешна
+    перепроверка). Строки нет — значит, доставка не падала."""
+
+    def __init__(self, db):
+        self.db    = db
+        self._down = {}   # uid → status, только недоступные
+
+    def __len__(self):
+        return len(self._down)
+
+    async def load(self):
+        rows = await self.db.fetchall("SELECT user_id, status FROM delivery WHERE status!='reachable'")
+        self._down = {r["user_id"]: r["status"] for r in rows}
+
+    def is_reachable(self, uid):
+        return uid not in self._down
+
+    @staticmethod
+    def classify(exc):
+        text = str(exc).lower()
+        if isinstance(exc, TelegramForbiddenError):
+            return "deactivated" if "deactivated" in text else "blocked"
+        if isinstance(exc, TelegramBadRequest) and "chat not found" in text:
+            return "deactivated"
+        return None
+
+    async def failed(self, uid, exc):
+        """Учесть ошибку отправки. True — получатель недоступен."""
+        status = self.classify(exc)
+        if status is None:
+            return False
+        self._down[uid] = status
+        await self.db.execute(
+            "INSERT OR REPLACE INTO delivery (user_id,status,last_error,updated_at) VALUES (?,?,?,?)",
+            (uid, status, str(exc)[:200], time.time())
+        )
+        return True
+
+    async def recovered(self, uid):
+        if self._down.pop(uid, None) is None:
+            return
+        await self.db.execute(
+            "UPDATE delivery SET status='reachable', updated_at=? WHERE user_id=?", (time.time(), uid)
+        )
+
+    async def reprobe(self, bot: Bot, older_than):
+        """Проверить давно недоступных «печатает…»: без сообщения в чате."""
+        rows = await self.db.fetchall(
+            "SELECT user_id FROM delivery WHERE status!='reachable' AND updated_at<? ORDER BY updated_at LIMIT ?",
+            (time.time() - older_than, DELIVERY_REPROBE_BATCH)
+        )
+        back = 0
+        for r in rows:
+            uid = r["user_id"]
+            await tg_limiter.acquire(uid)
+            try:
+                await bot.send_chat_action(uid, "typing")
+            except Exception as e:
+                if not await self.failed(uid, e):
+                    logger.debug(f"Reprobe {uid} inconclusive: {e}")
+                continue
+            await self.recovered(uid)
+            back += 1
+        return len(rows), back
 
-def get_all_user_ids():
-    rows = conn.execute("SELECT user_id FROM users WHERE is_banned=0").fetchall()
-    return [r["user_id"] for r in rows]
+delivery = DeliveryStatus(db)
+
+async def reprobe_loop(bot: Bot):
+    if not DELIVERY_REPROBE_DAYS:
+        return
+    while True:
+        await asyncio.sleep(60 * 60)
+        try:
+            checked, back = await delivery.reprobe(bot, DELIVERY_REPROBE_DAYS * 24 * 60 * 60)
+            if checked:
+                logger.info(f"Delivery reprobe: {back} of {checked} reachable again")
+        except Exception as e:
+            logger.error(f"Delivery reprobe error: {e}")
+
+async def iter_user_ids(after=0, page=500):
+    """Поток id получателей страницами по ключу, без загрузки всех в память."""
+    while True:
+        rows = await db.fetchall(
+            f"SELECT u.user_id FROM users u WHERE u.is_banned=0 AND u.user_id>? AND {REACHABLE_SQL} "
+            "ORDER BY u.user_id LIMIT ?",
+            (after, page)
+        )
+        if not rows:
+            return
+        yield [r["user_id"] for r in rows]
+        after = rows[-1]["user_id"]
+
+async def set_banned(uid, banned):
+    flag = int(banned)
+    changed = await db.update(
+        "UPDATE users SET is_banned=? WHERE user_id=? AND is_banned!=?", (flag, uid, flag)
+    )
+    user_cache.invalidate(uid)
+    if changed:
+        stats.banned += 1 if banned else -1
+
+async def add_report(reporter_id, reported_id, chat_id):
+    """id новой жалобы или None, если на этот чат уже жаловались."""
+    def op(c):
+        cur = c.execute(
+            "INSERT OR IGNORE INTO reports (reporter_id,reported_id,chat_id) VALUES (?,?,?)",
+            (reporter_id, reported_id, chat_id)
+        )
+        return cur.lastrowid if cur.rowcount else None
+    rid = await db.transaction(op, label="add_report")
+    if rid is None:
+        return None
+    stats.total_reports   += 1
+    stats.pending_reports += 1
+    return rid
+
+async def set_report_status(rid, status):
+    def op(c):
+        row = c.execute("SELECT status FROM reports WHERE id=?", (rid,)).fetchone()
+        c.execute("UPDATE reports SET status=? WHERE id=?", (status, rid))
+        return row["status"] if row else None
+    if await db.transaction(op, label="set_report_status") == "pending":
+        stats.pending_reports -= 1
+
+# ── Счётчики для статистики ─────────────────────────────────────
+class Stats:
+    """Счётчики для «Статистики» и админки. Меняются инкрементально там же,
+    где меняются данные; пары и поиск берутся из индексов в памяти.
+    reconcile() сверяет всё с БД на медленном расписании."""
+
+    def __init__(self):
+        self.users           = 0
+        self.banned          = 0
+        self.total_chats     = 0
+        self.pending_reports = 0
+        self.total_reports   = 0
+
+    @property
+    def active_pairs(self):
+        return len(active_chats) // 2
+
+    @property
+    def searching(self):
+        return len(matchmaker)
+
+    async def reconcile(self):
+        def counts(c):
+            return c.execute(
+                "SELECT (SELECT COUNT(*) FROM users), "
+                "(SELECT COUNT(*) FROM users WHERE is_banned=1), "
+                "(SELECT COUNT(*) FROM chats), "
+                "(SELECT COUNT(*) FROM reports WHERE status='pending'), "
+                "(SELECT COUNT(*) FROM reports)"
+            ).fetchone()
+        fresh = tuple(await db.run(counts, label="stats_reconcile"))
+        old = (self.users, self.banned, self.total_chats, self.pending_reports, self.total_reports)
+        if old != fresh:
+            logger.info(f"Stats reconciled: {old} -> {fresh}")
+        (self.users, self.banned, self.total_chats,
+         self.pending_reports, self.total_reports) = fresh
+
+stats = Stats()
+
+Gauge("bot_queue_length", "Пользователей в поиске", lambda: len(matchmaker))
+Gauge("bot_active_chats", "Активных пар", lambda: stats.active_pairs)
+Gauge("bot_outbox_pending", "Сообщений в исходящих очередях", lambda: len(outbox))
+Gauge("bot_user_cache_hits", "Попадания в кэш профилей", lambda: user_cache.hits)
+Gauge("bot_user_cache_misses", "Промахи кэша профилей", lambda: user_cache.misses)
+Gauge("bot_counters_pending", "Профилей с незаписанными счётчиками", lambda: len(counters))
+Gauge("bot_unreachable_users", "Заблокировали бота или удалили аккаунт", lambda: len(delivery))
+Gauge("bot_replica_age_seconds", "Возраст снимка для админки (-1 — нет)", lambda: replica.age() or -1)
+STATS_RECONCILE_S = 10 * 60
+
+async def stats_loop():
+    while True:
+        await asyncio.sleep(STATS_RECONCILE_S)
+        try:
+            await stats.reconcile()
+        except Exception as e:
+            logger.error(f"Stats reconcile error: {e}")
 
 # ═══════════════════════════════════════════════════════════════
-#  КЛАВИАТУРЫ
+#  ТЕКСТЫ И КЛАВИАТУРЫ
 # ═══════════════════════════════════════════════════════════════
+# Всё, что не зависит от пользователя, собирается один раз при импорте
+# и переиспользуется в каждом ответе. Общие объекты не изменять!
+
+# ── Статичные тексты ────────────────────────────────────────────
+WELCOME_TEXT = (
+    "╔══════════════════════════╗\n"
+    "║  🕵️ <b>АНОНИМНЫЙ ЧАТ</b>  ║\n"
+    "╚══════════════════════════╝\n\n"
+    "Привет! Здесь ты можешь анонимно общаться с незнакомцами.\n\n"
+    "✏️ <b>Как тебя зовут?</b>\n"
+    "<i>(введи своё имя или псевдоним)</i>"
+)
+
+SEARCHING_TEXT = (
+    "🔍 <b>Ищем собеседника…</b>\n\n"
+    "<i>Как только кто-то появится — чат начнётся автоматически!</i>"
+)
+
+# Шаблон: FOUND_TEXT.format(partner=…)
+FOUND_TEXT = (
+    "┌─────────────────────┐\n"
+    "│  ✅ <b>СОБЕСЕДНИК НАЙДЕН!</b>  │\n"
+    "└─────────────────────┘\n\n"
+    "👤 Партнёр: <b>{partner}</b>\n\n"
+    "💬 Начинайте общаться!\n"
+    "<i>«🚪 Покинуть чат» — чтобы выйти</i>"
+)
+
+END_TEXT = (
+    "┌──────────────────┐\n"
+    "│  👋 <b>ЧАТ ЗАВЕРШЁН</b>  │\n"
+    "└──────────────────┘"
+)
+
+PROFILE_HEAD = (
+    "┌──────────────────────┐\n"
+    "│      👤 <b>ВАШ ПРОФИЛЬ</b>      │\n"
+    "└──────────────────────┘\n\n"
+)
+STATS_HEAD = (
+    "┌──────────────────────┐\n"
+    "│      📊 <b>СТАТИСТИКА</b>       │\n"
+    "└──────────────────────┘\n\n"
+)
+REF_HEAD = (
+    "┌──────────────────────┐\n"
+    "│    🔗 <b>РЕФЕРАЛЬНАЯ</b>       │\n"
+    "└──────────────────────┘\n\n"
+)
+ADMIN_HEAD = (
+    "┌──────────────────────┐\n"
+    "│    🛡 <b>ПАНЕЛЬ АДМИНА</b>     │\n"
+    "└──────────────────────┘\n\n"
+)
+
+# ── Клавиатуры ──────────────────────────────────────────────────
+_MENU_ROWS = [
+    [KeyboardButton(text="🔍 Найти чат"),    KeyboardButton(text="👤 Профиль")],
+    [KeyboardButton(text="🔗 Реферальная"),  KeyboardButton(text="📊 Статистика")],
+]
+MENU_USER  = ReplyKeyboardMarkup(keyboard=_MENU_ROWS, resize_keyboard=True, persistent=True)
+MENU_ADMIN = ReplyKeyboardMarkup(
+    keyboard=_MENU_ROWS + [[KeyboardButton(text="🛡 Админ панель")]],
+    resize_keyboard=True, persistent=True
+)
 
 def main_menu(uid=0):
-    rows = [
-        [KeyboardButton(text="🔍 Найти чат"),    KeyboardButton(text="👤 Профиль")],
-        [KeyboardButton(text="🔗 Реферальная"),  KeyboardButton(text="📊 Статистика")],
-    ]
-    if uid == ADMIN_ID:
-        rows.append([KeyboardButton(text="🛡 Админ панель")])
-    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True, persistent=True)
+    return MENU_ADMIN if uid == ADMIN_ID else MENU_USER
+
+KB_REMOVE = ReplyKeyboardRemove()
 
 MENU_CHAT = ReplyKeyboardMarkup(
     keyboard=[[KeyboardButton(text="🚪 Покинуть чат")]],
@@ -172,21 +1749,77 @@ GENDER_KB = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
+PROFILE_KB = InlineKeyboardMarkup(inline_keyboard=[[
+    InlineKeyboardButton(text="✏️ Изменить имя", callback_data="change_name"),
+    InlineKeyboardButton(text="🎯 Фильтр поиска", callback_data="prefs"),
+]])
+
+ADMIN_PANEL_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📢 Сделать рассылку", callback_data="adm_broadcast")],
+    [InlineKeyboardButton(text="📈 Аналитика",        callback_data="adm_analytics")],
+])
+
+# Кнопки с данными чата: шаблон собирается один раз, на каждый чат кнопки
+# копируются с подставленным «{partner_id}_{chat_id}» — это втрое дешевле,
+# чем заново валидировать каждую InlineKeyboardButton.
+def _tpl(text, data):
+    return InlineKeyboardButton(text=text, callback_data=data)
+
+RATING_TEMPLATE = (
+    (_tpl("⭐ 1", "rate_{}_1"), _tpl("⭐⭐ 2", "rate_{}_2"), _tpl("⭐⭐⭐ 3", "rate_{}_3")),
+    (_tpl("⭐⭐⭐⭐ 4", "rate_{}_4"), _tpl("⭐⭐⭐⭐⭐ 5", "rate_{}_5")),
+    (_tpl("🚨 Пожаловаться", "report_{}"),),
+    (_tpl("✖️ Пропустить", "skip_rating"),),
+)
+REPORT_TEMPLATE = ((_tpl("🚨 Пожаловаться", "report_{}"), _tpl("✖️ Нет", "skip_rating")),)
+
+def _from_template(template, partner_id, chat_id):
+    key = f"{partner_id}_{chat_id}"
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [b.model_copy(update={"callback_data": b.callback_data.format(key)}) if "{}" in b.callback_data else b
+         for b in row]
+        for row in template
+    ])
+
 def rating_kb(partner_id, chat_id):
-    def b(t, s): return InlineKeyboardButton(text=t, callback_data=f"rate_{partner_id}_{chat_id}_{s}")
+    return _from_template(RATING_TEMPLATE, partner_id, chat_id)
+
+def report_kb(partner_id, chat_id):
+    """Предложение пожаловаться после оценки."""
+    return _from_template(REPORT_TEMPLATE, partner_id, chat_id)
+
+AGE_LABELS = {"any": "Любой возраст", "13_17": "13–17", "18_24": "18–24", "25_34": "25–34", "35_99": "35+"}
+
+def prefs_kb(gender, age_min, age_max, age):
+    """age — возраст самого человека: он определяет, какие диапазоны показать."""
+    def mark(on, t): return f"✅ {t}" if on else t
+    age_key = next((k for k, v in AGE_RANGES.items() if v == (age_min, age_max)), "any")
+    def g(t, v): return InlineKeyboardButton(text=mark(gender == v, t), callback_data=f"pref_g_{v or 'any'}")
+    def a(k): return InlineKeyboardButton(text=mark(age_key == k, AGE_LABELS[k]), callback_data=f"pref_a_{k}")
+    keys = age_ranges_for(age)
     return InlineKeyboardMarkup(inline_keyboard=[
-        [b("⭐ 1", 1), b("⭐⭐ 2", 2), b("⭐⭐⭐ 3", 3)],
-        [b("⭐⭐⭐⭐ 4", 4), b("⭐⭐⭐⭐⭐ 5", 5)],
-        [InlineKeyboardButton(text="🚨 Пожаловаться", callback_data=f"report_{partner_id}_{chat_id}")],
-        [InlineKeyboardButton(text="✖️ Пропустить",   callback_data="skip_rating")],
+        [g("👫 Любой пол", None), g("👦 Парни", "М"), g("👧 Девушки", "Ж")],
+        *([a(k) for k in keys[i:i + 2]] for i in range(0, len(keys), 2)),
     ])
 
-def admin_kb(report_id, reported_id):
-    return InlineKeyboardMarkup(inline_keyboard=[[
+def admin_kb(report_id, reported_id, chat_id=None, first_id=None):
+    rows = [[
         InlineKeyboardButton(text="🔨 Забанить",         callback_data=f"adm_ban_{report_id}_{reported_id}"),
         InlineKeyboardButton(text="✅ Пропустить",        callback_data=f"adm_skip_{report_id}"),
         InlineKeyboardButton(text="🔒 Закрыть проверку", callback_data=f"adm_close_{report_id}"),
-    ]])
+    ]]
+    if first_id is not None:
+        # «_new» — открыть страницы отдельным сообщением, не трогая жалобу
+        rows.append([InlineKeyboardButton(text="⬅️ Раньше", callback_data=f"dlg_{chat_id}_o_{first_id}_new")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def dialog_kb(chat_id, rows, older, newer):
+    buttons = []
+    if older:
+        buttons.append(InlineKeyboardButton(text="⬅️ Раньше", callback_data=f"dlg_{chat_id}_o_{rows[0]['id']}"))
+    if newer:
+        buttons.append(InlineKeyboardButton(text="Позже ➡️", callback_data=f"dlg_{chat_id}_n_{rows[-1]['id']}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons] if buttons else [])
 
 # ═══════════════════════════════════════════════════════════════
 #  РОУТЕР — FSM ХЭНДЛЕРЫ РЕГИСТРИРУЕМ ПЕРВЫМИ (важно!)
@@ -225,7 +1858,7 @@ async def reg_gender(message: Message, state: FSMContext):
     await message.answer(
         "📅 <b>Сколько тебе лет?</b>\n<i>(введи число от 13 до 99)</i>",
         parse_mode="HTML",
-        reply_markup=ReplyKeyboardRemove()
+        reply_markup=KB_REMOVE
     )
 
 # ── Регистрация: ШАГ 3 — возраст ────────────────────────────────
@@ -245,16 +1878,17 @@ async def reg_age(message: Message, state: FSMContext, bot: Bot):
     gender = data["gender"]
     ref_by = data.get("ref_by")
 
-    conn.execute(
+    created = await db.update(
         "INSERT OR IGNORE INTO users (user_id,name,gender,age,referred_by) VALUES (?,?,?,?,?)",
         (uid, name, gender, age, ref_by)
     )
-    conn.commit()
+    user_cache.invalidate(uid)
+    stats.users += created
 
-    if ref_by and get_user(ref_by):
-        conn.execute("UPDATE users SET ref_count=ref_count+1 WHERE user_id=?", (ref_by,))
-        conn.commit()
-        ru = get_user(ref_by)
+    if ref_by and await get_user(ref_by):
+        await db.execute("UPDATE users SET ref_count=ref_count+1 WHERE user_id=?", (ref_by,))
+        user_cache.bump(ref_by, ref_count=1)
+        ru = await get_user(ref_by)
         try:
             await bot.send_message(
                 ref_by,
@@ -262,7 +1896,8 @@ async def reg_age(message: Message, state: FSMContext, bot: Bot):
                 f"👥 Рефералов: <b>{ru['ref_count']}</b>",
                 parse_mode="HTML"
             )
-        except: pass
+        except Exception as e:
+            await delivery.failed(ref_by, e)
 
     await state.clear()
     icon = "👦" if gender == "М" else "👧"
@@ -285,8 +1920,8 @@ async def process_new_name(message: Message, state: FSMContext):
     if len(name) < 2 or len(name) > 30:
         await message.answer("❌ Имя от 2 до 30 символов. Попробуй ещё раз:")
         return
-    conn.execute("UPDATE users SET name=? WHERE user_id=?", (name, uid))
-    conn.commit()
+    await db.execute("UPDATE users SET name=? WHERE user_id=?", (name, uid))
+    user_cache.invalidate(uid)
     await state.clear()
     await message.answer(f"✅ <b>Имя изменено на: {name}</b>", parse_mode="HTML", reply_markup=main_menu(uid))
 
@@ -298,20 +1933,7 @@ async def process_broadcast(message: Message, state: FSMContext, bot: Bot):
         return
     text = message.text
     await state.clear()
-    user_ids = get_all_user_ids()
-    ok, fail = 0, 0
-    await message.answer(f"📤 Начинаю рассылку для {len(user_ids)} пользователей…")
-    for uid in user_ids:
-        try:
-            await bot.send_message(uid,
-                f"📢 <b>Сообщение от администратора:</b>\n\n{text}",
-                parse_mode="HTML"
-            )
-            ok += 1
-            await asyncio.sleep(0.05)
-        except:
-            fail += 1
-    await message.answer(f"✅ Рассылка завершена!\n📨 Доставлено: <b>{ok}</b>\n❌ Не доставлено: <b>{fail}</b>", parse_mode="HTML")
+    await start_broadcast(bot, message, f"📢 <b>Сообщение от администратора:</b>\n\n{text}")
 
 # ═══════════════════════════════════════════════════════════════
 #  /start
@@ -321,11 +1943,11 @@ async def start(message: Message, state: FSMContext):
     uid  = message.from_user.id
     args = message.text.split()[1] if len(message.text.split()) > 1 else ""
 
-    if is_banned(uid):
+    if await is_banned(uid):
         await message.answer("🚫 <b>Вы заблокированы.</b>", parse_mode="HTML")
         return
 
-    user = get_user(uid)
+    user = await get_user(uid)
     if user:
         await message.answer(
             f"╔═══════════════════╗\n"
@@ -350,22 +1972,17 @@ async def start(message: Message, state: FSMContext):
 
     await state.set_state(Reg.name)
     await state.update_data(ref_by=ref_by)
-    await message.answer(
-        "╔══════════════════════════╗\n"
-        "║  🕵️ <b>АНОНИМНЫЙ ЧАТ</b>  ║\n"
-        "╚══════════════════════════╝\n\n"
-        "Привет! Здесь ты можешь анонимно общаться с незнакомцами.\n\n"
-        "✏️ <b>Как тебя зовут?</b>\n"
-        "<i>(введи своё имя или псевдоним)</i>",
-        parse_mode="HTML",
-        reply_markup=ReplyKeyboardRemove()
-    )
+    await message.answer(WELCOME_TEXT, parse_mode="HTML", reply_markup=KB_REMOVE)
 
 # ═══════════════════════════════════════════════════════════════
 #  ПОИСК / ВЫХОД
 # ═══════════════════════════════════════════════════════════════
 
 async def do_find(uid, message: Message, bot: Bot):
+    async with matchmaker.lock(uid):
+        await _do_find(uid, message, bot)
+
+async def _do_find(uid, message: Message, bot: Bot):
     if get_partner(uid):
         await message.answer("❗ Вы уже в чате.", reply_markup=MENU_CHAT)
         return
@@ -373,41 +1990,135 @@ async def do_find(uid, message: Message, bot: Bot):
         await message.answer("🔍 Уже ищем, подождите…")
         return
 
-    waiting = conn.execute("SELECT user_id FROM queue WHERE user_id!=? LIMIT 1", (uid,)).fetchone()
-    if waiting:
-        pid = waiting["user_id"]
-        conn.execute("DELETE FROM queue WHERE user_id=?", (pid,))
-        conn.execute("INSERT INTO chats (user1_id,user2_id) VALUES (?,?)", (uid, pid))
-        conn.execute("UPDATE users SET chats_count=chats_count+1 WHERE user_id IN (?,?)", (uid, pid))
-        conn.commit()
-        u1, u2 = get_user(uid), get_user(pid)
-
-        def chat_text(partner):
-            return (
-                f"┌─────────────────────┐\n"
-                f"│  ✅ <b>СОБЕСЕДНИК НАЙДЕН!</b>  │\n"
-                f"└─────────────────────┘\n\n"
-                f"👤 Партнёр: <b>{user_display(partner)}</b>\n\n"
-                f"💬 Начинайте общаться!\n"
-                f"<i>«🚪 Покинуть чат» — чтобы выйти</i>"
-            )
-
-        await message.answer(chat_text(u2), parse_mode="HTML", reply_markup=MENU_CHAT)
-        await bot.send_message(pid, chat_text(u1), parse_mode="HTML", reply_markup=MENU_CHAT)
+    u = await get_user(uid)
+    seeker = Seeker(uid, u["gender"], u["age"], *await get_prefs(uid))
+    pid = matchmaker.match(seeker)
+    if pid:
+        await start_chat(uid, pid, claim_chat(uid, pid), bot)
     else:
-        conn.execute("INSERT OR IGNORE INTO queue (user_id) VALUES (?)", (uid,))
-        conn.commit()
-        await message.answer(
-            "🔍 <b>Ищем собеседника…</b>\n\n"
-            "<i>Как только кто-то появится — чат начнётся автоматически!</i>",
-            parse_mode="HTML",
-            reply_markup=main_menu(uid)
-        )
+        await matchmaker.add(seeker)
+        await message.answer(SEARCHING_TEXT, parse_mode="HTML", reply_markup=main_menu(uid))
+
+async def start_chat(uid, pid, chat_id, bot: Bot):
+    """Записать чат пары, занятой claim_chat(), и уведомить обоих."""
+    # Кто-то из пары мог выйти, пока она ждала записи: тогда чат пишется
+    # сразу завершённым. Флаг берётся без await перед транзакцией, а
+    # писатель один — поздний выход обновит уже вставленную строку.
+    ended = get_active_chat_id(uid) != chat_id
+
+    def pair(c):
+        c.execute("DELETE FROM queue WHERE user_id IN (?,?)", (uid, pid))
+        c.execute("INSERT INTO chats (id,user1_id,user2_id,ended,ended_at) VALUES (?,?,?,?,?)",
+                  (chat_id, uid, pid, int(ended), time.time() if ended else None))
+
+    await db.transaction(pair, label="start_chat")
+    stats.total_chats += 1
+    counters.add(uid, chats_count=1)
+    counters.add(pid, chats_count=1)
+    if ended:
+        return False
+    u1, u2 = await get_user(uid), await get_user(pid)
+
+    # Первым уведомляем pid: он ждал в пуле и скорее мог уйти. Если он
+    # недоступен, uid ещё ничего не видел — пара отменяется незаметно.
+    # Любая ошибка отменяет пару: иначе живой остался бы в чате, о котором
+    # не знает второй.
+    notified = False
+    for to, partner in ((pid, u1), (uid, u2)):
+        try:
+            await bot.send_message(to, FOUND_TEXT.format(partner=user_display(partner)),
+                                   parse_mode="HTML", reply_markup=MENU_CHAT)
+        except Exception as e:
+            live = uid if to == pid else pid
+            gone = await delivery.failed(to, e)
+            logger.info(f"Notify {to} failed ({e}), match {chat_id} cancelled")
+            await cancel_match(chat_id, to, live, bot, notified, requeue_dead=not gone)
+            return False
+        notified = True
+    return True
+
+async def cancel_match(chat_id, dead, live, bot: Bot, notified, requeue_dead=False):
+    """Пара сорвалась на уведомлении: чат удаляется как не начатый, живой
+    сразу ищет снова (строка queue пишется в той же транзакции). При
+    временном сбое (requeue_dead) в поиск возвращается и dead."""
+    u, prefs = await get_user(live), await get_prefs(live)
+    back = None
+    if requeue_dead:
+        d = await get_user(dead)
+        back = Seeker(dead, d["gender"], d["age"], *await get_prefs(dead))
+    if get_active_chat_id(live) != chat_id:
+        return   # живой успел выйти сам
+    close_chat(dead)
+    seeker = Seeker(live, u["gender"], u["age"], *prefs)
+    # Без await до транзакции: живой либо сразу в новой паре, либо снова в пуле.
+    # dead возвращается после подбора, чтобы живому не достался он же.
+    pid = matchmaker.match(seeker)
+    if pid:
+        new_chat = claim_chat(live, pid)
+    else:
+        matchmaker.restore(seeker)
+    if back:
+        matchmaker.restore(back)
+
+    def undo(c):
+        c.execute("DELETE FROM chats WHERE id=?", (chat_id,))
+        if pid is None:
+            c.execute("INSERT OR REPLACE INTO queue (user_id,last_seen) VALUES (?,?)", (live, seeker.last_seen))
+        if back:
+            c.execute("INSERT OR REPLACE INTO queue (user_id,last_seen) VALUES (?,?)", (dead, back.last_seen))
+
+    await db.transaction(undo, label="cancel_match")
+    stats.total_chats -= 1
+    counters.add(dead, chats_count=-1)
+    counters.add(live, chats_count=-1)
+    if pid:
+        await start_chat(live, pid, new_chat, bot)
+        return
+    text = "<i>Собеседник недоступен — продолжаем поиск.</i>\n\n" + SEARCHING_TEXT if notified else SEARCHING_TEXT
+    try:
+        await bot.send_message(live, text, parse_mode="HTML", reply_markup=main_menu(live))
+    except Exception as e:
+        if await delivery.failed(live, e):
+            await matchmaker.remove(live)
+
+QUEUE_EXPIRED_TEXT = (
+    "⌛ <b>Поиск остановлен</b> — вы давно не проявляли активность.\n"
+    "Нажмите «🔍 Найти чат», чтобы искать снова."
+)
+
+async def presence_loop(bot: Bot):
+    """Снимает с поиска тех, от кого не было апдейтов дольше QUEUE_TTL."""
+    while True:
+        await asyncio.sleep(QUEUE_SWEEP_S)
+        try:
+            stale = await matchmaker.expire(QUEUE_TTL)
+        except Exception as e:
+            logger.error(f"Queue sweep error: {e}")
+            continue
+        if stale:
+            logger.info(f"Queue sweep: {len(stale)} stale searchers removed")
+            QUEUE_EXPIRED.inc(value=len(stale))
+        for uid in stale:
+            outbox.put(uid, lambda uid=uid: bot.send_message(
+                uid, QUEUE_EXPIRED_TEXT, parse_mode="HTML", reply_markup=main_menu(uid)))
+
+async def rematch_loop(bot: Bot):
+    """Сводит тех, у кого истекло время ожидания по фильтру."""
+    while True:
+        await asyncio.sleep(5)
+        pairs = matchmaker.relaxed_pairs()
+        results = await asyncio.gather(*(start_chat(uid, pid, chat_id, bot) for uid, pid, chat_id in pairs),
+                                       return_exceptions=True)
+        for r in results:
+            if isinstance(r, Exception):
+                logger.error(f"Rematch error: {r}")
 
 async def do_leave(uid, message: Message, bot: Bot):
-    if in_queue(uid):
-        conn.execute("DELETE FROM queue WHERE user_id=?", (uid,))
-        conn.commit()
+    async with matchmaker.lock(uid):
+        await _do_leave(uid, message, bot)
+
+async def _do_leave(uid, message: Message, bot: Bot):
+    if await matchmaker.remove(uid):
         await message.answer("✅ Поиск отменён.", reply_markup=main_menu(uid))
         return
 
@@ -416,108 +2127,258 @@ async def do_leave(uid, message: Message, bot: Bot):
         await message.answer("❗ Вы не в чате.", reply_markup=main_menu(uid))
         return
 
-    user    = get_user(uid)
+    user    = await get_user(uid)
     chat_id = get_active_chat_id(uid)
-    conn.execute("UPDATE chats SET ended=1 WHERE id=?", (chat_id,))
-    conn.commit()
-
-    end_text = (
-        "┌──────────────────┐\n"
-        "│  👋 <b>ЧАТ ЗАВЕРШЁН</b>  │\n"
-        "└──────────────────┘"
-    )
+    close_chat(uid)
+    await end_chat_record(chat_id)
 
-    await message.answer(end_text, parse_mode="HTML", reply_markup=main_menu(uid))
+    await message.answer(END_TEXT, parse_mode="HTML", reply_markup=main_menu(uid))
     await message.answer("⭐ <b>Оцените собеседника:</b>", parse_mode="HTML", reply_markup=rating_kb(pid, chat_id))
 
+    # Через очередь партнёра — чтобы уведомление пришло после его последних сообщений
+    left_text = f"{END_TEXT}\n\n<i>Собеседник <b>{user_display(user)}</b> покинул чат.</i>"
+    outbox.put(pid, lambda: bot.send_message(pid, left_text, parse_mode="HTML", reply_markup=main_menu(pid)))
+    outbox.put(pid, lambda: bot.send_message(pid, "⭐ <b>Оцените собеседника:</b>", parse_mode="HTML",
+                                             reply_markup=rating_kb(uid, chat_id)))
+
+async def drop_unreachable(bot: Bot, dead_uid):
+    """Партнёр заблокировал бота: закрываем чат и сообщаем второму."""
+    entry = close_chat(dead_uid)
+    if not entry:
+        return
+    live, chat_id = entry
+    await end_chat_record(chat_id)
     await bot.send_message(
-        pid,
-        f"{end_text}\n\n<i>Собеседник <b>{user_display(user)}</b> покинул чат.</i>",
+        live,
+        f"{END_TEXT}\n\n<i>Собеседник недоступен — чат завершён.</i>",
         parse_mode="HTML",
-        reply_markup=main_menu(pid)
+        reply_markup=main_menu(live)
     )
-    await bot.send_message(pid, "⭐ <b>Оцените собеседника:</b>", parse_mode="HTML", reply_markup=rating_kb(uid, chat_id))
 
 # ═══════════════════════════════════════════════════════════════
 #  ПЕРЕСЫЛКА
 # ═══════════════════════════════════════════════════════════════
 
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "32"))
+OUTBOX_BATCH   = 20    # сколько отправок подряд в один чат, потом очередь следующему
+OUTBOX_RETRIES = 5
+
+class Outbox:
+    """Исходящие сообщения: у каждого получателя своя FIFO-очередь,
+    очереди разбирает пул воркеров. Один получатель обслуживается одним
+    воркером за раз — порядок внутри чата сохраняется, а медленный или
+    упёршийся в лимит чат не задерживает остальных.
+
+    Сетевые ошибки и 5xx повторяются с backoff, RetryAfter — ждём сколько
+    просят. Если получатель заблокировал бота, чат закрывается."""
+
+    def __init__(self, workers=OUTBOX_WORKERS):
+        self.workers  = workers
+        self.bot      = None
+        self._queues  = {}               # uid → deque[(send, on_failed)]
+        self._ready   = asyncio.Queue()  # uid с непустой очередью, никем не занятые
+        self._tasks   = []
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def put(self, uid, send, on_failed=None):
+        """send — функция без аргументов, возвращающая корутину отправки;
+        on_failed вызывается, если сообщение так и не доставлено."""
+        q = self._queues.get(uid)
+        if q is None:
+            q = self._queues[uid] = deque()
+            self._ready.put_nowait(uid)
+        q.append((send, on_failed))
+
+    async def _deliver(self, uid, send):
+        for attempt in range(OUTBOX_RETRIES):
+            try:
+                await send()
+                return True
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.warning(f"Outbox retry {attempt + 1} to {uid}: {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except TelegramForbiddenError as e:
+                logger.info(f"User {uid} blocked the bot, ending chat")
+                dropped = self._queues.get(uid, deque())
+                for _, on_failed in dropped:
+                    if on_failed:
+                        on_failed()
+                dropped.clear()
+                await delivery.failed(uid, e)
+                await drop_unreachable(self.bot, uid)
+                return False
+            except Exception as e:
+                logger.error(f"Relay error: {e}")
+                return False
+        logger.error(f"Relay to {uid} dropped after {OUTBOX_RETRIES} attempts")
+        return False
+
+    async def _worker(self):
+        while True:
+            uid = await self._ready.get()
+            try:
+                for _ in range(OUTBOX_BATCH):
+                    q = self._queues.get(uid)
+                    if not q:
+                        break
+                    send, on_failed = q.popleft()
+                    if not await self._deliver(uid, send) and on_failed:
+                        on_failed()
+            except Exception as e:
+                logger.error(f"Outbox worker error: {e}")
+            finally:
+                q = self._queues.get(uid)
+                if q:
+                    self._ready.put_nowait(uid)   # остаток — в конец, после других чатов
+                else:
+                    self._queues.pop(uid, None)
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while self._queues and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = []
+
+outbox = Outbox()
+
 async def relay(message: Message, bot: Bot, uid, pid):
-    user    = get_user(uid)
+    with HANDLER_SECONDS.time("relay"):
+        await _relay(message, bot, uid, pid)
+    RELAYED.inc()
+
+def relay_label(message: Message):
+    """Подпись сообщения для журнала переписки (None — тип не пересылаем)."""
+    if message.text:
+        return message.text
+    if message.photo:
+        return f"[📷 Фото]{' | '+message.caption if message.caption else ''}"
+    if message.video:
+        return "[🎥 Видео]"
+    if message.voice:
+        return "[🎤 Голосовое]"
+    if message.sticker:
+        return f"[🎭 Стикер {message.sticker.emoji or ''}]"
+    if message.animation:
+        return "[GIF]"
+    if message.document:
+        return f"[📎 {message.document.file_name}]"
+    if message.video_note:
+        return "[⭕ Видеосообщение]"
+    if message.audio:
+        return "[🎵 Аудио]"
+    return None
+
+UNDELIVERED = "[⚠️ не доставлено] "   # пометка в журнале для строки, которую партнёр не получил
+
+MEDIA_GROUP_WINDOW = 0.5   # сек. тишины, после которых альбом считается полным
+
+class MediaGroupBuffer:
+    """Копит части альбома (общий media_group_id) и пересылает их одним
+    copy_messages: партнёр получает альбом целиком и одно уведомление.
+
+    Место альбома в очереди партнёра занимается сразу, по первой части,
+    так что сообщения, отправленные после альбома, не обгонят его."""
+
+    def __init__(self, window=MEDIA_GROUP_WINDOW):
+        self.window  = window
+        self._groups = {}
+
+    def add(self, bot: Bot, message: Message, pid, chat_id, uid, display, label):
+        g = self._groups.get(message.media_group_id)
+        if g is None:
+            g = self._groups[message.media_group_id] = {
+                "from": message.chat.id, "items": [], "last": 0.0, "ready": asyncio.Event(),
+            }
+            group_id = message.media_group_id
+
+            async def send():
+                await g["ready"].wait()
+                await bot.copy_messages(pid, g["from"], [mid for mid, _ in sorted(g["items"])])
+
+            def on_failed():
+                if chat_id:
+                    for _, item_label in sorted(g["items"]):
+                        save_msg(chat_id, uid, display, UNDELIVERED + item_label)
+
+            outbox.put(pid, send, on_failed)
+            spawn(self._close_later(group_id))
+        g["items"].append((message.message_id, label))
+        if chat_id:
+            save_msg(chat_id, uid, display, label)
+        g["last"] = time.monotonic()
+
+    async def _close_later(self, group_id):
+        g = self._groups[group_id]
+        while (delay := g["last"] + self.window - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        del self._groups[group_id]
+        g["ready"].set()
+
+media_groups = MediaGroupBuffer()
+
+async def _relay(message: Message, bot: Bot, uid, pid):
+    user    = await get_user(uid)
     chat_id = get_active_chat_id(uid)
     display = user_display(user)
-    conn.execute("UPDATE users SET messages_sent=messages_sent+1 WHERE user_id=?", (uid,))
-    conn.commit()
+    counters.add(uid, messages_sent=1)
 
-    label = None
-    try:
-        if message.text:
-            await bot.send_message(pid, f"💬 {message.text}")
-            label = message.text
-        elif message.photo:
-            await bot.send_photo(pid, message.photo[-1].file_id, caption=message.caption or "")
-            label = f"[📷 Фото]{' | '+message.caption if message.caption else ''}"
-        elif message.video:
-            await bot.send_video(pid, message.video.file_id, caption=message.caption or "")
-            label = "[🎥 Видео]"
-        elif message.voice:
-            await bot.send_voice(pid, message.voice.file_id)
-            label = "[🎤 Голосовое]"
-        elif message.sticker:
-            await bot.send_sticker(pid, message.sticker.file_id)
-            label = f"[🎭 Стикер {message.sticker.emoji or ''}]"
-        elif message.animation:
-            await bot.send_animation(pid, message.animation.file_id)
-            label = "[GIF]"
-        elif message.document:
-            await bot.send_document(pid, message.document.file_id, caption=message.caption or "")
-            label = f"[📎 {message.document.file_name}]"
-        elif message.video_note:
-            await bot.send_video_note(pid, message.video_note.file_id)
-            label = "[⭕ Видеосообщение]"
-        elif message.audio:
-            await bot.send_audio(pid, message.audio.file_id)
-            label = "[🎵 Аудио]"
-    except Exception as e:
-        logger.error(f"Relay error: {e}")
+    label = relay_label(message)
+    if label is None:
+        return
+    if message.media_group_id:
+        media_groups.add(bot, message, pid, chat_id, uid, display, label)
+        return
 
-    if chat_id and label:
+    # В журнал — сразу при постановке в очередь: жалоба, поданная, пока
+    # очередь партнёра ждёт RetryAfter, всё равно видит последние строки
+    if chat_id:
         save_msg(chat_id, uid, display, label)
 
+    def on_failed():
+        if chat_id:
+            save_msg(chat_id, uid, display, UNDELIVERED + label)
+
+    from_chat, mid = message.chat.id, message.message_id
+    outbox.put(pid, lambda: bot.copy_message(pid, from_chat, mid), on_failed)
+
 # ═══════════════════════════════════════════════════════════════
 #  ПРОФИЛЬ / СТАТИСТИКА / РЕФЕРАЛЬНАЯ / АДМИН
 # ═══════════════════════════════════════════════════════════════
 
 async def show_profile(uid, message: Message):
-    u  = get_user(uid)
+    u  = counters.with_pending(await get_user(uid))
+    rating = await avg_rating(uid)
     icon = "👦" if u["gender"] == "М" else "👧"
-    kb = InlineKeyboardMarkup(inline_keyboard=[[
-        InlineKeyboardButton(text="✏️ Изменить имя", callback_data="change_name")
-    ]])
     await message.answer(
-        f"┌──────────────────────┐\n"
-        f"│      👤 <b>ВАШ ПРОФИЛЬ</b>      │\n"
-        f"└──────────────────────┘\n\n"
+        f"{PROFILE_HEAD}"
         f"✏️ Имя: <b>{u['name']}</b>\n"
         f"{icon} Пол: <b>{'Мужской' if u['gender'] == 'М' else 'Женский'}</b>\n"
         f"📅 Возраст: <b>{u['age']} лет</b>\n\n"
         f"💬 Чатов: <b>{u['chats_count']}</b>\n"
         f"✉️ Сообщений: <b>{u['messages_sent']}</b>\n"
-        f"⭐ Рейтинг: <b>{avg_rating(uid)}</b>\n"
+        f"⭐ Рейтинг: <b>{rating}</b>\n"
         f"👥 Рефералов: <b>{u['ref_count']}</b>",
         parse_mode="HTML",
-        reply_markup=kb
+        reply_markup=PROFILE_KB
     )
 
 async def show_stats(message: Message):
-    total    = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-    in_chat  = conn.execute("SELECT COUNT(*) FROM chats WHERE ended=0").fetchone()[0]
-    searching= conn.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
-    total_ch = conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+    total    = stats.users
+    in_chat  = stats.active_pairs
+    searching= stats.searching
+    total_ch = stats.total_chats
     await message.answer(
-        f"┌──────────────────────┐\n"
-        f"│      📊 <b>СТАТИСТИКА</b>       │\n"
-        f"└──────────────────────┘\n\n"
+        f"{STATS_HEAD}"
         f"👥 Всего пользователей: <b>{total}</b>\n"
         f"💬 Пар в чате сейчас: <b>{in_chat}</b>\n"
         f"🔍 В поиске: <b>{searching}</b>\n"
@@ -526,45 +2387,104 @@ async def show_stats(message: Message):
     )
 
 async def show_ref(uid, message: Message, bot: Bot):
-    me   = await bot.get_me()
+    me   = await bot.me()   # aiogram кэширует ответ, прогрев запрашивает его при старте
     link = f"https://t.me/{me.username}?start=ref_{uid}"
-    u    = get_user(uid)
+    u    = await get_user(uid)
     await message.answer(
-        f"┌──────────────────────┐\n"
-        f"│    🔗 <b>РЕФЕРАЛЬНАЯ</b>       │\n"
-        f"└──────────────────────┘\n\n"
+        f"{REF_HEAD}"
         f"Ваша ссылка:\n<code>{link}</code>\n\n"
         f"👥 Вы пригласили: <b>{u['ref_count']}</b> чел.\n\n"
         f"<i>Поделитесь ссылкой с друзьями!</i>",
         parse_mode="HTML"
     )
 
+def _admin_numbers(c):
+    day_ago = time.time() - 24 * 60 * 60
+    return c.execute(
+        "SELECT (SELECT COUNT(*) FROM chats WHERE ended=1 AND ended_at>?), "
+        "       (SELECT COUNT(*) FROM messages WHERE created_at>?), "
+        "       (SELECT COUNT(*) FROM messages)",
+        (day_ago, day_ago)
+    ).fetchone()
+
+def _analytics(c):
+    day_ago = time.time() - 24 * 60 * 60
+    one = lambda sql, *p: c.execute(sql, p).fetchone()
+    return {
+        "gender":   c.execute("SELECT gender, COUNT(*) AS n FROM users GROUP BY gender ORDER BY n DESC").fetchall(),
+        "ages":     c.execute(
+            "SELECT CASE WHEN age<18 THEN '13–17' WHEN age<25 THEN '18–24' "
+            "            WHEN age<35 THEN '25–34' ELSE '35+' END AS band, COUNT(*) AS n "
+            "FROM users GROUP BY band ORDER BY band"
+        ).fetchall(),
+        "chats":    one("SELECT COUNT(*), SUM(ended=1 AND ended_at>?) FROM chats", day_ago),
+        "messages": one("SELECT COUNT(*), SUM(created_at>?) FROM messages", day_ago),
+        "ratings":  one("SELECT COUNT(*), AVG(score) FROM ratings"),
+        "reports":  c.execute("SELECT status, COUNT(*) AS n FROM reports GROUP BY status ORDER BY n DESC").fetchall(),
+        "reported": c.execute(
+            "SELECT reported_id, COUNT(*) AS n FROM reports GROUP BY reported_id ORDER BY n DESC LIMIT 5"
+        ).fetchall(),
+        "delivery": c.execute("SELECT status, COUNT(*) AS n FROM delivery GROUP BY status").fetchall(),
+    }
+
+def _report_history(c, uid, before_id):
+    return c.execute(
+        "SELECT COUNT(*), SUM(status='banned') FROM reports WHERE reported_id=? AND id<?", (uid, before_id)
+    ).fetchone()
+
+async def show_analytics(uid, message: Message):
+    if uid != ADMIN_ID:
+        return
+    a = await replica.read(_analytics)
+
+    def pairs(rows):
+        return ", ".join(f"{r[0]}: <b>{r[1]}</b>" for r in rows) or "—"
+
+    chats_total, chats_day = a["chats"]
+    msgs_total, msgs_day   = a["messages"]
+    rated, avg_score       = a["ratings"]
+    await message.answer(
+        f"📈 <b>Аналитика</b>\n\n"
+        f"👫 Пол: {pairs(a['gender'])}\n"
+        f"📅 Возраст: {pairs(a['ages'])}\n\n"
+        f"🗂 Чатов: <b>{chats_total}</b>, завершено за сутки: <b>{chats_day or 0}</b>\n"
+        f"✉️ Сообщений в базе: <b>{msgs_total}</b>, за сутки: <b>{msgs_day or 0}</b>\n"
+        f"⭐ Оценок: <b>{rated}</b>, средняя: <b>{avg_score or 0:.2f}</b>\n\n"
+        f"🚨 Жалобы: {pairs(a['reports'])}\n"
+        f"🎯 Чаще всего жалуются на: {pairs(a['reported'])}\n"
+        f"📵 Доставка: {pairs(a['delivery'])}\n\n"
+        f"{replica.freshness()}",
+        parse_mode="HTML"
+    )
+
 async def show_admin(uid, message: Message):
     if uid != ADMIN_ID:
         return
-    total   = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-    banned  = conn.execute("SELECT COUNT(*) FROM users WHERE is_banned=1").fetchone()[0]
-    pending = conn.execute("SELECT COUNT(*) FROM reports WHERE status='pending'").fetchone()[0]
-    in_chat = conn.execute("SELECT COUNT(*) FROM chats WHERE ended=0").fetchone()[0]
-    search  = conn.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
-    total_r = conn.execute("SELECT COUNT(*) FROM reports").fetchone()[0]
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📢 Сделать рассылку", callback_data="adm_broadcast")],
-    ])
+    chats_day, msgs_day, msgs_total = await replica.read(_admin_numbers)
+    total   = stats.users
+    banned  = stats.banned
+    pending = stats.pending_reports
+    in_chat = stats.active_pairs
+    search  = stats.searching
+    total_r = stats.total_reports
     await message.answer(
-        f"┌──────────────────────┐\n"
-        f"│    🛡 <b>ПАНЕЛЬ АДМИНА</b>     │\n"
-        f"└──────────────────────┘\n\n"
+        f"{ADMIN_HEAD}"
         f"👥 Пользователей: <b>{total}</b>\n"
         f"🚫 Забанено: <b>{banned}</b>\n"
+        f"📵 Недоступны: <b>{len(delivery)}</b>\n"
         f"💬 В чате: <b>{in_chat}</b> пар\n"
         f"🔍 В поиске: <b>{search}</b>\n"
         f"🚨 Жалоб (ожидают): <b>{pending}</b>\n"
-        f"📋 Всего жалоб: <b>{total_r}</b>\n\n"
+        f"📋 Всего жалоб: <b>{total_r}</b>\n"
+        f"🗃 Кэш профилей: <b>{user_cache.hit_rate():.0%}</b> "
+        f"({user_cache.hits} hit / {user_cache.misses} miss)\n\n"
+        f"🗂 Чатов за сутки: <b>{chats_day}</b>\n"
+        f"✉️ Сообщений за сутки: <b>{msgs_day}</b> (в базе {msgs_total})\n"
+        f"{replica.freshness()}\n\n"
         f"<code>/ban ID</code> — забанить\n"
         f"<code>/unban ID</code> — разбанить",
         parse_mode="HTML",
-        reply_markup=kb
+        reply_markup=ADMIN_PANEL_KB
     )
 
 # ═══════════════════════════════════════════════════════════════
@@ -576,13 +2496,13 @@ async def handle_text(message: Message, state: FSMContext, bot: Bot):
     uid  = message.from_user.id
     text = message.text
 
-    if is_banned(uid):
+    if await is_banned(uid):
         await message.answer("🚫 Вы заблокированы.")
         return
 
-    user = get_user(uid)
+    user = await get_user(uid)
     if not user:
-        await message.answer("Напишите /start чтобы начать.", reply_markup=ReplyKeyboardRemove())
+        await message.answer("Напишите /start чтобы начать.", reply_markup=KB_REMOVE)
         return
 
     if text == "🔍 Найти чат":
@@ -611,7 +2531,7 @@ async def handle_text(message: Message, state: FSMContext, bot: Bot):
 @router.message(F.photo | F.video | F.voice | F.sticker | F.animation | F.document | F.video_note | F.audio)
 async def handle_media(message: Message, bot: Bot):
     uid = message.from_user.id
-    if is_banned(uid) or not get_user(uid):
+    if await is_banned(uid) or not await get_user(uid):
         return
     pid = get_partner(uid)
     if not pid:
@@ -633,10 +2553,46 @@ async def callbacks(call: CallbackQuery, state: FSMContext, bot: Bot):
 
     if d == "change_name":
         await state.set_state(ChangeName.waiting)
-        await call.message.answer("✏️ <b>Введите новое имя:</b>", parse_mode="HTML", reply_markup=ReplyKeyboardRemove())
+        await call.message.answer("✏️ <b>Введите новое имя:</b>", parse_mode="HTML", reply_markup=KB_REMOVE)
+        await call.answer()
+        return
+
+    if d == "prefs":
+        await call.message.answer(
+            "🎯 <b>Фильтр поиска</b>\n\n"
+            "Кого искать в первую очередь?\n"
+            f"<i>Если подходящий собеседник не найдётся за {MATCH_RELAX_AFTER} сек., "
+            "подберём любого.</i>",
+            parse_mode="HTML",
+            reply_markup=prefs_kb(*await get_prefs(uid), (await get_user(uid))["age"])
+        )
         await call.answer()
         return
 
+    if d.startswith("pref_"):
+        age = (await get_user(uid))["age"]
+        old = await get_prefs(uid)
+        gender, age_min, age_max = old
+        kind, value = d[5], d[7:]
+        if kind == "g":
+            gender = None if value == "any" else value
+        elif value in age_ranges_for(age):
+            age_min, age_max = AGE_RANGES[value]
+        else:
+            await call.answer("Этот диапазон недоступен.", show_alert=True)
+            return
+        # Повторное нажатие на выбранный вариант: клавиатура та же, а Telegram
+        # на неизменённую разметку отвечает 400
+        if (gender, age_min, age_max) != old:
+            await set_prefs(uid, gender, age_min, age_max)
+            try:
+                await call.message.edit_reply_markup(reply_markup=prefs_kb(gender, age_min, age_max, age))
+            except TelegramBadRequest as e:
+                if "not modified" not in str(e):
+                    raise
+        await call.answer("Сохранено ✅")
+        return
+
     if d == "adm_broadcast":
         if uid != ADMIN_ID:
             await call.answer("Нет прав.", show_alert=True)
@@ -645,11 +2601,19 @@ async def callbacks(call: CallbackQuery, state: FSMContext, bot: Bot):
         await call.message.answer(
             "📢 <b>Введите текст рассылки:</b>\n<i>Сообщение получат все пользователи бота.</i>",
             parse_mode="HTML",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=KB_REMOVE
         )
         await call.answer()
         return
 
+    if d == "adm_analytics":
+        if uid != ADMIN_ID:
+            await call.answer("Нет прав.", show_alert=True)
+            return
+        await show_analytics(uid, call.message)
+        await call.answer()
+        return
+
     if d == "skip_rating":
         await call.message.edit_text("✖️ Оценка пропущена.")
         await call.answer()
@@ -659,19 +2623,22 @@ async def callbacks(call: CallbackQuery, state: FSMContext, bot: Bot):
     if d.startswith("rate_"):
         parts = d.split("_")
         pid, cid, score = int(parts[1]), int(parts[2]), int(parts[3])
-        if conn.execute("SELECT 1 FROM ratings WHERE rater_id=? AND chat_id=?", (uid, cid)).fetchone():
+
+        def rate(c):
+            if not c.execute("INSERT OR IGNORE INTO ratings (rater_id,rated_id,chat_id,score) VALUES (?,?,?,?)",
+                             (uid, pid, cid, score)).rowcount:
+                return False
+            c.execute("UPDATE users SET rating_sum=rating_sum+?, rating_count=rating_count+1 WHERE user_id=?", (score, pid))
+            return True
+
+        if not await db.transaction(rate, label="rate"):
             await call.answer("Вы уже оценили этот чат.", show_alert=True)
             return
-        conn.execute("INSERT INTO ratings (rater_id,rated_id,chat_id,score) VALUES (?,?,?,?)", (uid, pid, cid, score))
-        conn.execute("UPDATE users SET rating_sum=rating_sum+?, rating_count=rating_count+1 WHERE user_id=?", (score, pid))
-        conn.commit()
+        user_cache.bump(pid, rating_sum=score, rating_count=1)
         await call.message.edit_text(
             f"✅ Оценка поставлена: {'⭐'*score}\n\n<i>Хотите пожаловаться?</i>",
             parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text="🚨 Пожаловаться", callback_data=f"report_{pid}_{cid}"),
-                InlineKeyboardButton(text="✖️ Нет",          callback_data="skip_rating"),
-            ]])
+            reply_markup=report_kb(pid, cid)
         )
         await call.answer()
         return
@@ -680,27 +2647,37 @@ async def callbacks(call: CallbackQuery, state: FSMContext, bot: Bot):
     if d.startswith("report_"):
         parts = d.split("_")
         pid, cid = int(parts[1]), int(parts[2])
-        if conn.execute("SELECT 1 FROM reports WHERE reporter_id=? AND chat_id=?", (uid, cid)).fetchone():
+        rid = await add_report(uid, pid, cid)
+        if rid is None:
             await call.answer("Вы уже жаловались.", show_alert=True)
             return
-        res = conn.execute("INSERT INTO reports (reporter_id,reported_id,chat_id) VALUES (?,?,?)", (uid, pid, cid))
-        rid = res.lastrowid
-        conn.commit()
 
-        reporter = get_user(uid)
-        reported = get_user(pid)
-        dialog   = format_dialog(cid)
+        reporter = await get_user(uid)
+        reported = await get_user(pid)
+        rows, older, _ = await dialog_page(cid)
+        history  = await replica.read(_report_history, pid, rid)
 
         admin_text = (
             f"🚨 <b>ЖАЛОБА #{rid}</b>\n\n"
-            f"👤 От: <b>{user_display(reporter)}</b> (<code>{uid}</code>)\n"
-            f"🎯 На: <b>{user_display(reported)}</b> (<code>{pid}</code>)\n\n"
-            f"📋 <b>Диалог чата #{cid}:</b>\n"
-            f"{'─'*28}\n<code>{dialog}</code>"
+            f"👤 От: <b>{html.escape(user_display(reporter))}</b> (<code>{uid}</code>)\n"
+            f"🎯 На: <b>{html.escape(user_display(reported))}</b> (<code>{pid}</code>)\n"
+            f"📂 Раньше на него: <b>{history[0]}</b> жалоб, из них с баном: <b>{history[1] or 0}</b> "
+            f"<i>(по снимку)</i>\n\n"
+            f"📋 <b>Диалог чата #{cid}</b>"
+            f"{' (последние строки)' if older else ''}:\n"
+            f"{'─'*28}\n<code>{render_dialog(rows)}</code>"
         )
         if ADMIN_ID:
             try:
-                await bot.send_message(ADMIN_ID, admin_text, parse_mode="HTML", reply_markup=admin_kb(rid, pid))
+                kb = admin_kb(rid, pid, cid, rows[0]["id"] if older else None)
+                await bot.send_message(ADMIN_ID, admin_text, parse_mode="HTML", reply_markup=kb)
+                if rows:
+                    path = await dialog_file(cid)
+                    try:
+                        await bot.send_document(ADMIN_ID, FSInputFile(path, filename=f"chat_{cid}.txt"),
+                                                caption=f"📋 Полный диалог чата #{cid} (жалоба #{rid})")
+                    finally:
+                        os.remove(path)
             except Exception as e:
                 logger.error(f"Admin error: {e}")
 
@@ -708,6 +2685,26 @@ async def callbacks(call: CallbackQuery, state: FSMContext, bot: Bot):
         await call.answer()
         return
 
+    # Листание диалога в жалобе
+    if d.startswith("dlg_"):
+        if uid != ADMIN_ID:
+            await call.answer("Нет прав.", show_alert=True)
+            return
+        parts  = d.split("_")
+        cid, direction, anchor = int(parts[1]), parts[2], int(parts[3])
+        if direction == "o":
+            rows, older, newer = await dialog_page(cid, before=anchor)
+        else:
+            rows, older, newer = await dialog_page(cid, after=anchor)
+        text = f"📋 <b>Диалог чата #{cid}</b>\n{'─'*28}\n<code>{render_dialog(rows)}</code>"
+        kb   = dialog_kb(cid, rows, older, newer)
+        if len(parts) > 4:
+            await call.message.answer(text, parse_mode="HTML", reply_markup=kb)
+        else:
+            await call.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+        await call.answer()
+        return
+
     # Админ действия
     if d.startswith("adm_ban_"):
         if uid != ADMIN_ID:
@@ -715,14 +2712,14 @@ async def callbacks(call: CallbackQuery, state: FSMContext, bot: Bot):
             return
         parts = d.split("_")
         rid, target = int(parts[2]), int(parts[3])
-        conn.execute("UPDATE users SET is_banned=1 WHERE user_id=?", (target,))
-        conn.execute("UPDATE reports SET status='banned' WHERE id=?", (rid,))
-        conn.commit()
+        await set_banned(target, True)
+        await set_report_status(rid, "banned")
         try:
             await bot.send_message(target, "🚫 <b>Вы заблокированы.</b>", parse_mode="HTML")
-        except: pass
-        t = get_user(target)
-        await call.message.edit_text(call.message.text + f"\n\n🔨 <b>{t['name']} ЗАБАНЕН</b>", parse_mode="HTML")
+        except Exception as e:
+            await delivery.failed(target, e)
+        t = await get_user(target)
+        await call.message.edit_text(call.message.html_text + f"\n\n🔨 <b>{html.escape(t['name'])} ЗАБАНЕН</b>", parse_mode="HTML")
         await call.answer("Забанен ✅")
         return
 
@@ -731,9 +2728,8 @@ async def callbacks(call: CallbackQuery, state: FSMContext, bot: Bot):
             await call.answer("Нет прав.", show_alert=True)
             return
         rid = int(d.split("_")[2])
-        conn.execute("UPDATE reports SET status='skipped' WHERE id=?", (rid,))
-        conn.commit()
-        await call.message.edit_text(call.message.text + "\n\n✅ <b>Жалоба пропущена</b>", parse_mode="HTML")
+        await set_report_status(rid, "skipped")
+        await call.message.edit_text(call.message.html_text + "\n\n✅ <b>Жалоба пропущена</b>", parse_mode="HTML")
         await call.answer()
         return
 
@@ -742,9 +2738,8 @@ async def callbacks(call: CallbackQuery, state: FSMContext, bot: Bot):
             await call.answer("Нет прав.", show_alert=True)
             return
         rid = int(d.split("_")[2])
-        conn.execute("UPDATE reports SET status='closed' WHERE id=?", (rid,))
-        conn.commit()
-        await call.message.edit_text(call.message.text + "\n\n🔒 <b>Проверка закрыта</b>", parse_mode="HTML")
+        await set_report_status(rid, "closed")
+        await call.message.edit_text(call.message.html_text + "\n\n🔒 <b>Проверка закрыта</b>", parse_mode="HTML")
         await call.answer()
         return
 
@@ -756,7 +2751,7 @@ async def callbacks(call: CallbackQuery, state: FSMContext, bot: Bot):
 
 @router.message(Command("find"))
 async def find_cmd(message: Message, bot: Bot):
-    if not get_user(message.from_user.id):
+    if not await get_user(message.from_user.id):
         await message.answer("Сначала /start")
         return
     await do_find(message.from_user.id, message, bot)
@@ -769,6 +2764,10 @@ async def leave_cmd(message: Message, bot: Bot):
 async def admin_cmd(message: Message):
     await show_admin(message.from_user.id, message)
 
+@router.message(Command("analytics"))
+async def analytics_cmd(message: Message):
+    await show_analytics(message.from_user.id, message)
+
 @router.message(Command("ban"))
 async def ban_cmd(message: Message, bot: Bot):
     if message.from_user.id != ADMIN_ID:
@@ -779,8 +2778,7 @@ async def ban_cmd(message: Message, bot: Bot):
         return
     try:
         target = int(parts[1])
-        conn.execute("UPDATE users SET is_banned=1 WHERE user_id=?", (target,))
-        conn.commit()
+        await set_banned(target, True)
         await message.answer(f"✅ Пользователь {target} забанен.")
         await bot.send_message(target, "🚫 <b>Вы заблокированы.</b>", parse_mode="HTML")
     except Exception as e:
@@ -796,13 +2794,142 @@ async def unban_cmd(message: Message, bot: Bot):
         return
     try:
         target = int(parts[1])
-        conn.execute("UPDATE users SET is_banned=0 WHERE user_id=?", (target,))
-        conn.commit()
+        await set_banned(target, False)
         await message.answer(f"✅ Пользователь {target} разбанен.")
         await bot.send_message(target, "✅ <b>Ваш бан снят!</b>", parse_mode="HTML")
     except Exception as e:
         await message.answer(f"Ошибка: {e}")
 
+# ═══════════════════════════════════════════════════════════════
+#  РАССЫЛКИ
+# ═══════════════════════════════════════════════════════════════
+
+BROADCAST_RATE        = float(os.environ.get("BROADCAST_RATE", "25"))  # сообщений/с на бота
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PAGE        = 500
+BROADCAST_PROGRESS_S  = 5
+
+class RateLimiter:
+    """Токен-бакет под лимиты Telegram: rate сообщений/с на бота и не чаще
+    одного сообщения в per_chat секунд в один чат. pause() — общий стоп
+    по RetryAfter."""
+
+    def __init__(self, rate, per_chat=1.0):
+        self.rate          = rate
+        self.per_chat      = per_chat
+        self._tokens       = rate
+        self._updated      = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next    = {}
+        self._lock         = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id):
+        wait = self._chat_next.get(chat_id, 0) - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        async with self._lock:
+            while True:
+                now  = time.monotonic()
+                wait = self._paused_until - now
+                if wait <= 0:
+                    self._tokens  = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        break
+                    wait = (1 - self._tokens) / self.rate
+                await asyncio.sleep(wait)
+            self._chat_next[chat_id] = now + self.per_chat
+            if len(self._chat_next) > 10_000:
+                self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+
+tg_limiter = RateLimiter(BROADCAST_RATE)
+
+async def send_limited(bot: Bot, uid, text, retries=5):
+    """Отправка через общий лимитер. True — доставлено, False — нет."""
+    for attempt in range(retries):
+        await tg_limiter.acquire(uid)
+        try:
+            await bot.send_message(uid, text, parse_mode="HTML")
+            return True
+        except TelegramRetryAfter as e:
+            logger.warning(f"RetryAfter {e.retry_after}s on {uid}")
+            tg_limiter.pause(e.retry_after)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            logger.warning(f"Transient send error to {uid}: {e}")
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            if not await delivery.failed(uid, e):
+                logger.debug(f"Send to {uid} failed: {e}")
+            return False
+    return False
+
+async def start_broadcast(bot: Bot, message: Message, text):
+    total = stats.users - stats.banned - len(delivery)   # оценка: забаненные и недоступные могут совпадать
+    progress = await message.answer(f"📤 Начинаю рассылку для {total} пользователей…")
+    job_id = await db.execute(
+        "INSERT INTO broadcasts (text,total,admin_chat,progress_id) VALUES (?,?,?,?)",
+        (text, total, message.chat.id, progress.message_id)
+    )
+    job = await db.fetchone("SELECT * FROM broadcasts WHERE id=?", (job_id,))
+    spawn(run_broadcast(bot, job))
+
+async def resume_broadcasts(bot: Bot):
+    for job in await db.fetchall("SELECT * FROM broadcasts WHERE status='running'"):
+        logger.info(f"Resuming broadcast #{job['id']} after user {job['last_uid']}")
+        spawn(run_broadcast(bot, job))
+
+async def run_broadcast(bot: Bot, job):
+    """Рассылка страницами по user_id. После каждой страницы — чекпоинт
+    (last_uid, ok, fail), так что после рестарта продолжаем с того же места."""
+    job_id, text = job["id"], job["text"]
+    ok, fail, total = job["ok"], job["fail"], job["total"]
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_report = time.monotonic()
+
+    async def report(final=False):
+        if not job["admin_chat"]:
+            return
+        if final:
+            body = f"✅ Рассылка завершена!\n📨 Доставлено: <b>{ok}</b>\n❌ Не доставлено: <b>{fail}</b>"
+        else:
+            body = f"📤 Рассылка #{job_id}: <b>{ok + fail}</b> / {total}\n📨 {ok}  ❌ {fail}"
+        try:
+            await bot.edit_message_text(body, chat_id=job["admin_chat"],
+                                        message_id=job["progress_id"], parse_mode="HTML")
+        except Exception as e:
+            logger.debug(f"Broadcast progress error: {e}")
+
+    async def one(uid):
+        nonlocal ok, fail
+        async with sem:
+            if await send_limited(bot, uid, text):
+                ok += 1
+            else:
+                fail += 1
+
+    last_uid = job["last_uid"]
+    try:
+        async for page in iter_user_ids(last_uid, BROADCAST_PAGE):
+            await asyncio.gather(*(one(uid) for uid in page))
+            await db.execute("UPDATE broadcasts SET last_uid=?, ok=?, fail=? WHERE id=?",
+                             (page[-1], ok, fail, job_id))
+            last_uid = page[-1]
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_S:
+                last_report = time.monotonic()
+                await report()
+
+        await db.execute("UPDATE broadcasts SET status='done', ok=?, fail=? WHERE id=?", (ok, fail, job_id))
+    except Exception as e:
+        # Статус остаётся 'running': resume_broadcasts продолжит с чекпоинта
+        logger.error(f"Broadcast #{job_id} stopped after user {last_uid}, will resume on restart: {e}")
+        return
+    logger.info(f"Broadcast #{job_id} done: ok={ok} fail={fail}")
+    await report(final=True)
+
 # ═══════════════════════════════════════════════════════════════
 #  АВТОРАССЫЛКА КАЖДЫЕ 4 ЧАСА
 # ═══════════════════════════════════════════════════════════════
@@ -815,35 +2942,312 @@ PROMO = [
     "⚡ <b>Новые знакомства каждый день!</b>\n\nОбщайся анонимно, без лишних вопросов.\nЭто бесплатно! 😉",
 ]
 
+PROMO_INTERVAL    = 4 * 60 * 60  # 4 часа
+PROMO_FIRST_DELAY = 60          # самый первый запуск — через минуту
+PROMO_RETRY_S     = 60          # пауза после ошибки
+
+async def iter_promo_audience(after=0, page=500):
+    """Незабаненные, не в чате и не в поиске — один анти-джойн на страницу."""
+    while True:
+        rows = await db.fetchall(
+            "SELECT u.user_id FROM users u "
+            f"WHERE u.is_banned=0 AND u.user_id>? AND {REACHABLE_SQL} AND u.user_id NOT IN ("
+            "  SELECT user1_id FROM chats WHERE ended=0"
+            "  UNION ALL SELECT user2_id FROM chats WHERE ended=0"
+            "  UNION ALL SELECT user_id FROM queue"
+            ") ORDER BY u.user_id LIMIT ?",
+            (after, page)
+        )
+        if not rows:
+            return
+        yield [r["user_id"] for r in rows]
+        after = rows[-1]["user_id"]
+
+async def get_job_time(name):
+    return await db.scalar("SELECT next_run FROM jobs WHERE name=?", (name,))
+
+async def set_job_time(name, next_run):
+    await db.execute(
+        "INSERT INTO jobs (name,next_run) VALUES (?,?) "
+        "ON CONFLICT(name) DO UPDATE SET next_run=excluded.next_run",
+        (name, next_run)
+    )
+
+async def promo_round(bot: Bot):
+    # Расписание хранится в jobs, поэтому рестарт не сбрасывает 4-часовой таймер
+    next_run = await get_job_time("auto_promo")
+    if next_run is None:
+        next_run = time.time() + PROMO_FIRST_DELAY
+        await set_job_time("auto_promo", next_run)
+    await asyncio.sleep(max(0, next_run - time.time()))
+    # Сдвигаем таймер до отправки: падение посреди рассылки не приведёт к повтору
+    await set_job_time("auto_promo", time.time() + PROMO_INTERVAL)
+
+    text = random.choice(PROMO)
+    sent = 0
+    sem  = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def one(uid):
+        nonlocal sent
+        async with sem:
+            if not get_partner(uid) and await send_limited(bot, uid, text):
+                sent += 1
+
+    async for page in iter_promo_audience():
+        await asyncio.gather(*(one(uid) for uid in page))
+    logger.info(f"Auto promo sent to {sent} users")
+
 async def auto_promo(bot: Bot):
-    await asyncio.sleep(60)  # Первая рассылка через минуту после старта (потом каждые 4ч)
     while True:
-        user_ids = get_all_user_ids()
-        text = random.choice(PROMO)
-        sent = 0
-        for uid in user_ids:
-            if get_partner(uid):
+        try:
+            await promo_round(bot)
+        except Exception as e:
+            logger.error(f"Auto promo error: {e}")
+            await asyncio.sleep(PROMO_RETRY_S)
+
+# ═══════════════════════════════════════════════════════════════
+#  WEBHOOK
+# ═══════════════════════════════════════════════════════════════
+# BOT_MODE=webhook поднимает aiohttp-сервер вместо long polling.
+# Без WEBHOOK_URL вебхук в Telegram не регистрируется — удобно для
+# локальной проверки: записанные апдейты можно слать curl'ом
+#   curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -H "Content-Type: application/json" -d @update.json \
+#        http://127.0.0.1:8080/webhook
+# Только в этом режиме WEBHOOK_SECRET можно не задавать. С WEBHOOK_URL
+# без секрета на каждый запуск генерируется случайный: иначе публичный
+# адрес принял бы поддельные апдейты от кого угодно.
+
+BOT_MODE        = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL     = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_PATH    = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET  = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_HOST    = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT    = int(os.environ.get("WEBHOOK_PORT", "8080"))
+WEBHOOK_QUEUE   = int(os.environ.get("WEBHOOK_QUEUE", "1000"))
+# Апдейтов в обработке одновременно; потолок — примерно
+# WEBHOOK_WORKERS / время хэндлера (с задержкой Bot API) апдейтов в секунду
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "64"))
+
+def _update_user_id(update):
+    for key in ("message", "edited_message", "callback_query", "my_chat_member"):
+        if key in update:
+            return update[key].get("from", {}).get("id", 0)
+    return 0
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Приём апдейтов в ограниченную очередь, которую разбирают воркеры.
+
+    Очередь общая, воркеры берут из неё кто свободен. Апдейты одного
+    пользователя идут по порядку: если его апдейт уже обрабатывается,
+    следующий откладывается в его цепочку, и её дорабатывает тот же
+    воркер, а взявший освобождается для других. Медленный хэндлер держит
+    только своего пользователя. Если принято maxsize необработанных
+    апдейтов, отвечаем 503, и Telegram повторит доставку позже."""
+
+    def __init__(self, dispatcher, bot, secret_token=None, maxsize=1000, workers=64):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token)
+        self.maxsize  = maxsize
+        self.workers  = workers
+        self.queue    = asyncio.Queue()
+        self._chains  = {}   # uid → deque апдейтов, ждущих за обрабатываемым
+        self._pending = 0    # принято, но ещё не обработано
+        self._workers = []
+
+    async def _handle_request_background(self, bot, request):
+        update = await request.json(loads=bot.session.json_loads)
+        if self._pending >= self.maxsize:
+            return web.Response(status=503, text="Busy")
+        self._pending += 1
+        self.queue.put_nowait(update)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _feed(self, update):
+        try:
+            await self._background_feed_update(self.bot, update)
+        except Exception as e:
+            logger.error(f"Webhook update error: {e}")
+        finally:
+            self._pending -= 1
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            uid = _update_user_id(update)
+            if not uid:
+                await self._feed(update)
                 continue
+            chain = self._chains.get(uid)
+            if chain is not None:
+                chain.append(update)   # доработает воркер, занятый этим пользователем
+                continue
+            chain = self._chains[uid] = deque()
             try:
-                await bot.send_message(uid, text, parse_mode="HTML")
-                sent += 1
-                await asyncio.sleep(0.05)
-            except:
-                pass
-        logger.info(f"Auto promo sent to {sent} users")
-        await asyncio.sleep(4 * 60 * 60)  # 4 часа
+                await self._feed(update)
+                while chain:
+                    await self._feed(chain.popleft())
+            finally:
+                del self._chains[uid]
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def qsize(self):
+        return self._pending
+
+    async def health(self, request):
+        return web.json_response({"status": "ok", "queue": self.qsize(), "workers": len(self._workers)})
+
+    async def close(self):
+        # Дорабатываем то, что уже принято, и только потом гасим воркеров
+        deadline = time.monotonic() + 10
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._pending:
+            logger.warning(f"Webhook shutdown: {self.qsize()} updates dropped")
+        for w in self._workers:
+            w.cancel()
+        await super().close()
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    secret = WEBHOOK_SECRET
+    if WEBHOOK_URL and not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET is not set, using a random secret for this run")
+    handler = QueuedRequestHandler(dp, bot, secret_token=secret or None,
+                                   maxsize=WEBHOOK_QUEUE, workers=WEBHOOK_WORKERS)
+    app = web.Application()
+    handler.register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/healthz", handler.health)
+    app.router.add_get("/readyz", readyz)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    handler.start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    logger.info(f"Webhook on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 # ═══════════════════════════════════════════════════════════════
 #  ЗАПУСК
 # ═══════════════════════════════════════════════════════════════
 
+# ── Прогрев ─────────────────────────────────────────────────────
+# Самые частые запросы. Выполнить их один раз — значит скомпилировать и
+# положить в кэш подготовленных выражений sqlite3 (он ищет по тексту,
+# поэтому строки должны совпадать с кодом) и поднять страницы индексов.
+HOT_READS = (
+    ("SELECT * FROM users WHERE user_id=?", (0,)),
+    ("SELECT gender, age_min, age_max FROM search_prefs WHERE user_id=?", (0,)),
+    ("SELECT state, data, updated_at FROM fsm WHERE key=?", ("",)),
+)
+HOT_WRITES = (
+    ("INSERT INTO messages (chat_id,sender_id,display,content,ts,created_at) VALUES (?,?,?,?,?,?)",
+     (0, 0, "", "", "", 0)),
+    ("UPDATE users SET chats_count=chats_count+?, messages_sent=messages_sent+? WHERE user_id=?", (0, 0, 0)),
+)
+
+def _prepare_reads(c):
+    for sql, params in HOT_READS:
+        c.execute(sql, params).fetchall()
+
+def _prepare_statements(c):
+    _prepare_reads(c)
+    # Запись — в откатываемой транзакции: нужен только разбор выражения
+    c.execute("BEGIN")
+    try:
+        for sql, params in HOT_WRITES:
+            c.execute(sql, params)
+    finally:
+        c.rollback()
+
+def _load_users(c, uids):
+    rows = []
+    for i in range(0, len(uids), 500):
+        chunk = uids[i:i + 500]
+        rows += c.execute(f"SELECT * FROM users WHERE user_id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+    return rows
+
+async def preload_users():
+    """Профили тех, кто в чате или в поиске, и забаненных: их апдейты придут первыми."""
+    gen  = user_cache.generation
+    uids = list(active_chats) + list(matchmaker)
+    rows = await db.read(_load_users, uids[:user_cache.maxsize])
+    rows += await db.fetchall("SELECT * FROM users WHERE is_banned=1 LIMIT ?", (user_cache.maxsize // 10,))
+    for r in rows:
+        user_cache.put(r["user_id"], dict(r), gen)
+    return len(rows)
+
+async def warm_up(bot: Bot):
+    """Всё, что нужно до первого апдейта: схема, индексы в памяти, кэши."""
+    await init_db()
+    await load_active_chats()
+    await matchmaker.load()
+    await stats.reconcile()
+    await delivery.load()
+    fsm_keys = await fsm_storage.preload()
+    users    = await preload_users()
+    await db.run(_prepare_statements)
+    await db.warm_readers(_prepare_reads)
+    me = await bot.me()
+    logger.info(f"Warm-up: @{me.username}, {users} profiles and {fsm_keys} FSM keys cached")
+
+def build_dispatcher():
+    """Диспетчер со всеми хэндлерами и метриками (main и benchmarks/load.py)."""
+    dp = Dispatcher(storage=fsm_storage)
+    router.message.middleware(handler_metrics)
+    router.callback_query.middleware(handler_metrics)
+    router.message.middleware(presence)
+    router.callback_query.middleware(presence)
+    dp.include_router(router)
+    return dp
+
 async def main():
+    t0  = time.perf_counter()
     bot = Bot(token=BOT_TOKEN)
-    dp  = Dispatcher(storage=MemoryStorage())
-    dp.include_router(router)
-    logger.info("✅ Бот запущен!")
+    bot.session.middleware(api_metrics)
+    dp  = build_dispatcher()
+    metrics_runner = await start_metrics_server()
+    await warm_up(bot)
+    msg_log.start()
+    counters.start()
+    fsm_storage.start()
+    outbox.start(bot)
     asyncio.create_task(auto_promo(bot))
-    await dp.start_polling(bot)
+    asyncio.create_task(rematch_loop(bot))
+    asyncio.create_task(presence_loop(bot))
+    asyncio.create_task(reprobe_loop(bot))
+    asyncio.create_task(replica_loop())
+    asyncio.create_task(stats_loop())
+    asyncio.create_task(compaction_loop())
+    await resume_broadcasts(bot)
+    ready.set()
+    logger.info(f"✅ Бот запущен за {time.perf_counter() - t0:.2f} с")
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        ready.clear()
+        await outbox.close()
+        await msg_log.close()
+        await counters.close()
+        await fsm_storage.close()
+        await replica.close()
+        await db.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())